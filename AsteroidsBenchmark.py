@@ -0,0 +1,310 @@
+from __future__ import division, print_function
+import time
+import AsteroidsSurvival as game
+import pygame
+import platform
+import random
+import math
+import json
+import gc
+import os
+import sys
+import tempfile
+import subprocess
+
+# scripted headless worlds built from the real entities, timed over a fixed
+# number of ticks. results go to benchmark_results.json and are compared with
+# benchmark_baseline.json if there is one, any scenario that got slower or
+# allocates more than the tolerance allows fails the run. both files are named
+# after the interpreter, since numbers from CPython and PyPy can't be compared.
+# only CPython 2.7 and 3 have actually been run. PyPy3 is unverified: nothing
+# here has been run on it, there's no PyPy baseline and no PyPy numbers. numpy
+# goes through cpyext there, so the array-backed asteroids and particles may
+# well turn out slower than on CPython
+
+# startup is timed this many times and the best taken, and is only a
+# regression once it's this many seconds past the tolerance as well
+STARTUP_RUNS = 5
+STARTUP_SLACK = 0.05
+
+class AllocationCounter:
+    # adds up how many more blocks are allocated after each tick than before
+    # it. the cyclic collector is off while counting, so garbage in cycles is
+    # counted as it's made, while temporaries freed by reference counting
+    # within the tick aren't. CPython 3 counts every block through
+    # sys.getallocatedblocks, python 2 only has the collector's count of
+    # container objects and PyPy has neither, so it reports None there
+    def __init__(self):
+        self.read = None
+        if hasattr(sys, "getallocatedblocks"):
+            self.read = sys.getallocatedblocks
+        elif hasattr(gc, "get_count"):
+            self.read = lambda: gc.get_count()[0]
+        self.allocations = 0
+        self.last = 0
+        self.wasEnabled = False
+    def start(self):
+        if self.read is None: return
+        gc.collect()
+        self.wasEnabled = gc.isenabled()
+        gc.disable()
+        self.allocations = 0
+        self.last = self.read()
+    def tick(self):
+        if self.read is None: return
+        now = self.read()
+        if now > self.last:
+            self.allocations += now - self.last
+        self.last = now
+    def stop(self):
+        if self.read is None: return None
+        if self.wasEnabled:
+            gc.enable()
+        gc.collect()
+        return self.allocations
+
+def makeWorld(seed):
+    context = game.GameContext()
+    context.toastManager = game.makeToastManager(context.clock)
+    world = game.World(context, seed)
+    world.spawner.maximum = 0 # scenarios decide what's in the world
+    world.player.score = 1000000.0
+    return world
+
+def addAsteroids(world, count):
+    factory = world.spawner.factory
+    for x in range(count):
+        factory.make(world.spawner)
+
+def asteroidScenario(world, size):
+    addAsteroids(world, size)
+    return None
+
+def bulletScenario(world, size):
+    player = world.player
+    width, height = game.getResolution()
+    def topUp(world):
+        bullets = len(world.entities.system("projectiles"))
+        for x in range(size - bullets):
+            x, y = random.uniform(0, width), random.uniform(0, height)
+            bullet = game.Bullet.pool.acquire(x, y, player.bulletSize, random.uniform(0, 2 * math.pi), player.bulletSpeed, player)
+            bullet.setClipValues((0,0), (width, height), True)
+            world.entities.spawn(bullet)
+        world.entities.flush()
+    addAsteroids(world, 10)
+    return topUp
+
+def emitterScenario(world, size):
+    player = world.player
+    def fillEmitters(world):
+        for emitter in [player.emitter, player.pewpewEmitter]:
+            emitter.pos = player.pos
+            # the particle budget can turn some of these away
+            for x in range(emitter.maxParticles - emitter.count):
+                emitter.setDirection(random.uniform(0, 2 * math.pi), random.uniform(1, 5))
+                emitter.emit()
+    return fillEmitters
+
+def evasionScenario(world, size):
+    world.player.addModifier(game.AutoEvasionModifier(world.player))
+    addAsteroids(world, size)
+    return None
+
+def breakupScenario(world, size):
+    player = world.player
+    def shootEverything(world):
+        asteroids = world.asteroids
+        if asteroids.count < size:
+            addAsteroids(world, size - asteroids.count)
+        if world.ticks % 10 != 0: return
+        for x, y in asteroids.positions[:asteroids.count].tolist():
+            bullet = game.Bullet.pool.acquire(x, y, player.bulletSize, 0.0, 0.0, player)
+            world.entities.spawn(bullet)
+        world.entities.flush()
+    return shootEverything
+
+def sightScenario(world, size):
+    # the level 2 laser sight drawn every tick while the ship drifts and
+    # turns, so the path it draws is different every time
+    player = world.player
+    sight = game.LaserSightModifierLevel2(player)
+    player.addModifier(sight)
+    screen = pygame.Surface(game.getResolution())
+    def drawSight(world):
+        player.vel.set(0.7, 0.4)
+        player.bearing += 0.01
+        sight.render(screen)
+    addAsteroids(world, size)
+    return drawSight
+
+SCENARIOS = [
+    ("asteroids", asteroidScenario, 200),
+    ("bullets", bulletScenario, 100),
+    ("emitters", emitterScenario, 0),
+    ("evasion", evasionScenario, 200),
+    ("breakups", breakupScenario, 50),
+    ("field", asteroidScenario, 5000),
+    ("sight", sightScenario, 20),
+]
+
+def runScenario(name, setup, size, ticks, seed):
+    world = makeWorld(seed)
+    perTick = setup(world, size)
+    counter = AllocationCounter()
+    peak = 0
+    counter.start()
+    start = time.time()
+    for tick in range(ticks):
+        if perTick is not None:
+            perTick(world)
+        world.step()
+        # the benchmark player can't lose, otherwise it stops doing anything
+        world.player.lostGame = False
+        world.context.reset = False
+        peak = max(peak, world.entityCount())
+        counter.tick()
+    taken = time.time() - start
+    allocations = counter.stop()
+    perTick = None
+    if allocations is not None:
+        perTick = allocations / float(ticks)
+    return {"size": size, "ticks": ticks, "seconds": taken, "ticksPerSecond": ticks / max(taken, 0.000001),\
+            "allocations": allocations, "allocationsPerTick": perTick, "entitiesPeak": peak}
+
+def interpreter():
+    # e.g. "cpython3.11" or "pypy3.9"
+    return "%s%s.%s" % (platform.python_implementation().lower(), sys.version_info[0], sys.version_info[1])
+
+def measureImport():
+    # a module is only imported once per process, so each try is a new one
+    code = "import time; start = time.time(); import AsteroidsSurvival; print(time.time() - start)"
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output([sys.executable, "-c", code], cwd = here)
+    return float(output.decode("ascii", "replace").split()[-1])
+
+def measureStartup(seed):
+    # importing the game (pygame, numpy and all) and building the first
+    # world, the best of a few tries since a single one is mostly noise
+    imports = []
+    worlds = []
+    for run in range(STARTUP_RUNS):
+        imports.append(measureImport())
+        start = time.time()
+        makeWorld(seed)
+        worlds.append(time.time() - start)
+    return {"seconds": min(imports) + min(worlds), "import": min(imports), "world": min(worlds), "runs": STARTUP_RUNS}
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for name, result in sorted(results.items()):
+        if name not in baseline: continue
+        expected = baseline[name]
+        if "ticksPerSecond" not in result:
+            if result["seconds"] > expected["seconds"] * (1.0 + tolerance) + STARTUP_SLACK:
+                failures.append("%s: %.2fs, baseline %.2fs" % (name, result["seconds"], expected["seconds"]))
+            continue
+        if result["ticksPerSecond"] < expected["ticksPerSecond"] * (1.0 - tolerance):
+            failures.append("%s: %.1f ticks/s, baseline %.1f" % (name, result["ticksPerSecond"], expected["ticksPerSecond"]))
+        allocations, expectedAllocations = result["allocationsPerTick"], expected.get("allocationsPerTick")
+        if allocations is not None and expectedAllocations is not None\
+           and allocations > expectedAllocations * (1.0 + tolerance) + 1:
+            failures.append("%s: %.1f allocations/tick, baseline %.1f" % (name, allocations, expectedAllocations))
+    return failures
+
+class KeyMasher:
+    # presses and lets go of random keys now and then. it only ever acts
+    # through events, so everything it does ends up in the replay log
+    keys = [pygame.K_w, pygame.K_a, pygame.K_d, pygame.K_SPACE]
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.held = set()
+    def __call__(self, world):
+        if self.random.random() > 0.05: return []
+        wanted = set([key for key in self.keys if self.random.random() < 0.4])
+        events = []
+        for key in sorted(self.held - wanted):
+            events.append(pygame.event.Event(pygame.KEYUP, {"key": key, "mod": 0}))
+        for key in sorted(wanted - self.held):
+            events.append(pygame.event.Event(pygame.KEYDOWN, {"key": key, "mod": 0}))
+        self.held = wanted
+        return events
+
+def checkReplay(ticks, seed):
+    # records a headless session, plays it back and checks every world came
+    # out the same: seed, how many ticks it lasted and the final score
+    handle, replayName = tempfile.mkstemp(".replay")
+    os.close(handle)
+    live = []
+    replayed = []
+    try:
+        game.runHeadless(ticks, KeyMasher(seed), game.ReplayWriter(replayName), summaries = live)
+        game.runReplay(replayName, True, replayed)
+    finally:
+        os.remove(replayName)
+    failures = []
+    if len(live) != len(replayed):
+        failures.append("replay: %s worlds played, %s replayed" % (len(live), len(replayed)))
+    for index, (played, replay) in enumerate(zip(live, replayed)):
+        if played != replay:
+            failures.append("replay: world %s was (seed, ticks, score) %s, replayed as %s" % (index, played, replay))
+    return len(live), failures
+
+def argument(name, default):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+def main():
+    ticks = int(argument("--ticks", 600))
+    seed = int(argument("--seed", 1234))
+    tolerance = float(argument("--tolerance", 0.2))
+    baselineName = argument("--baseline", "benchmark_baseline_%s.json" % interpreter())
+    resultsName = argument("--output", "benchmark_results_%s.json" % interpreter())
+    only = argument("--scenario", None)
+    replayTicks = int(argument("--replay-ticks", 5000))
+    pygame.font.init()
+    # benchmark players are rich, don't let them into the real high scores
+    game.getSettings().readonly = True
+    results = {}
+    worlds, replayFailures = checkReplay(replayTicks, seed)
+    print("replay check: %s ticks over %s worlds, %s" % (replayTicks, worlds, "mismatch" if replayFailures else "matched"))
+    startup = measureStartup(seed)
+    results["startup"] = startup
+    print("%s %s, startup %.2fs (import %.2fs, first world %.3fs, best of %d)" % (platform.python_implementation(),\
+          platform.python_version(), startup["seconds"], startup["import"], startup["world"], startup["runs"]))
+    for name, setup, size in SCENARIOS:
+        if only is not None and name != only: continue
+        result = runScenario(name, setup, size, ticks, seed)
+        results[name] = result
+        allocations = "n/a"
+        if result["allocationsPerTick"] is not None:
+            allocations = "%.1f" % result["allocationsPerTick"]
+        print("%-10s %8.1f ticks/s %10s allocations/tick %6d peak entities" % (name, result["ticksPerSecond"],\
+              allocations, result["entitiesPeak"]))
+    f = open(resultsName, "w")
+    json.dump(results, f, indent = 2, sort_keys = True)
+    f.close()
+    for failure in replayFailures:
+        print("REPLAY MISMATCH %s" % failure)
+    if replayFailures: return 1
+    if "--save-baseline" in sys.argv:
+        f = open(baselineName, "w")
+        json.dump(results, f, indent = 2, sort_keys = True)
+        f.close()
+        print("saved baseline to %s" % baselineName)
+        return 0
+    try:
+        f = open(baselineName, "r")
+    except IOError:
+        print("no baseline at %s, run with --save-baseline to make one" % baselineName)
+        return 0
+    baseline = json.load(f)
+    f.close()
+    failures = compare(results, baseline, tolerance)
+    for failure in failures:
+        print("REGRESSION %s" % failure)
+    if failures: return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
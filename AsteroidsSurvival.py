@@ -1,15 +1,309 @@
+from __future__ import division, print_function
 import pygame
+import numpy
 import random
 import time
 import math
 import sys
 import os
+import collections
+import json
+import struct
+import threading
+import itertools
+import gc
+
+timer = getattr(time, "perf_counter", time.time)
+
+try:
+    input = raw_input # python 2's input() evaluates whatever's typed
+except NameError:
+    pass
+
+# python 3 changed how the random module turns its numbers into ranges, these
+# work the way python 2 did on every interpreter so a seed always plays out
+# the same game
+def randrange(stop, source = random):
+    return int(source.random() * stop)
+
+def randint(low, high, source = random):
+    return low + int(source.random() * (high - low + 1))
 
 __screenResolution = [800,600]
 __fullscreenValue = False
+__dirtyRectsValue = False
+__fonts = {}
+__circleSprites = {}
+__spriteBatch = None
+__profiler = None
+__settings = None
+__pools = []
 
 def makeFont(size):
-    return pygame.font.Font("freesansbold.ttf", size)
+    global __fonts
+    if size not in __fonts:
+        __fonts[size] = pygame.font.Font("freesansbold.ttf", size)
+    return __fonts[size]
+
+class TextCache:
+    # rendered text keyed by (text, size, colour, antialias), the least
+    # recently used surfaces are dropped once we're holding maxBytes of pixels
+    def __init__(self, maxBytes = 4 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.usedBytes = 0
+        self.entries = collections.OrderedDict()
+    def render(self, text, size, colour, antialias = True):
+        key = (text, size, tuple(colour), antialias)
+        surface = self.entries.pop(key, None)
+        if surface is None:
+            surface = makeFont(size).render(text, antialias, colour)
+            width, height = surface.get_size()
+            self.usedBytes += width * height * surface.get_bytesize()
+            while self.entries and self.usedBytes > self.maxBytes:
+                oldKey, old = self.entries.popitem(last = False)
+                width, height = old.get_size()
+                self.usedBytes -= width * height * old.get_bytesize()
+        self.entries[key] = surface
+        return surface
+
+__textCache = TextCache()
+
+def renderText(text, size, colour, antialias = True):
+    global __textCache
+    return __textCache.render(text, size, colour, antialias)
+
+class HudText:
+    # HUD values change all the time, so rather than fill the shared cache
+    # with them each line keeps its own surface until its text changes
+    def __init__(self, size, colour):
+        self.size = size
+        self.colour = colour
+        self.text = None
+        self.surface = None
+    def update(self, text, colour = None):
+        if colour is None: colour = self.colour
+        if text != self.text or colour != self.colour or self.surface is None:
+            self.text = text
+            self.colour = colour
+            self.surface = makeFont(self.size).render(text, True, colour)
+        return self.surface
+
+def circleSprite(radius, colour):
+    # every circle in the game is one of a handful of (radius, colour) pairs,
+    # so each is drawn once onto a colour keyed surface and blitted from then on
+    global __circleSprites
+    key = (radius, tuple(colour))
+    sprite = __circleSprites.get(key)
+    if sprite is None:
+        size = radius * 2 + 1
+        sprite = pygame.Surface((size, size))
+        if pygame.display.get_surface() is not None:
+            sprite = sprite.convert()
+        sprite.fill((255,0,255))
+        pygame.draw.circle(sprite, colour, (radius, radius), radius)
+        sprite.set_colorkey((255,0,255), pygame.RLEACCEL)
+        __circleSprites[key] = sprite
+    return sprite
+
+class SpriteBatch:
+    def __init__(self, dest):
+        self.dest = dest
+        self.pending = []
+    def flush(self):
+        drawn = []
+        if self.pending:
+            drawn = self.dest.blits(self.pending)
+        self.pending = []
+        return drawn
+
+def beginSpriteBatch(dest):
+    # until endSpriteBatch() sprites drawn onto dest are queued up and handed
+    # to a single Surface.blits call
+    global __spriteBatch
+    __spriteBatch = SpriteBatch(dest)
+
+def endSpriteBatch():
+    global __spriteBatch
+    batch = __spriteBatch
+    __spriteBatch = None
+    if batch is None: return []
+    return batch.flush()
+
+def drawSprites(dest, sprites):
+    # sprites is a list of (surface, topLeft) pairs
+    global __spriteBatch
+    if __spriteBatch is not None and __spriteBatch.dest is dest:
+        __spriteBatch.pending.extend(sprites)
+    elif sprites:
+        dest.blits(sprites)
+
+def overlaps(bounds, topLeft, bottomRight):
+    # bounds is (left, top, right, bottom) and can be any size, one that
+    # covers the whole area overlaps it as much as one poking in at a corner
+    x1, y1, x2, y2 = bounds
+    return x1 <= bottomRight[0] and x2 >= topLeft[0] and y1 <= bottomRight[1] and y2 >= topLeft[1]
+
+def unionBounds(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def drawCircle(dest, colour, pos, radius):
+    x, y = pos
+    radius = int(radius)
+    drawSprites(dest, [(circleSprite(radius, colour), (int(x) - radius, int(y) - radius))])
+
+class Pool:
+    # spare objects of one kind kept for reuse instead of being made and
+    # dropped every few ticks. acquire() takes the same arguments as the
+    # constructor and hands them to reset() on a spare one if there is one
+    def __init__(self, name, make, limit):
+        self.name = name
+        self.make = make
+        self.limit = limit
+        self.spare = []
+        self.hits = 0
+        self.misses = 0
+    def acquire(self, *args):
+        if self.spare:
+            self.hits += 1
+            item = self.spare.pop()
+            item.reset(*args)
+            return item
+        self.misses += 1
+        return self.make(*args)
+    def release(self, item):
+        if len(self.spare) < self.limit:
+            self.spare.append(item)
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "spare": len(self.spare)}
+
+def makePool(name, make, limit = 256):
+    global __pools
+    pool = Pool(name, make, limit)
+    __pools.append(pool)
+    return pool
+
+def poolStats():
+    global __pools
+    return dict([(pool.name, pool.stats()) for pool in __pools])
+
+class FrameProfiler:
+    # wall time spent in each phase of the main loop per frame, plus think and
+    # render time per entity class. entity times are inclusive, so a Bullet's
+    # think also counts the ParticleEmitter it drives. frames are kept as
+    # (phase times, idle), idle frames are the ones the game slept through
+    # without drawing, they're kept in the series but left out of the
+    # percentiles and means so they don't drag them down
+    phases = ["events", "notify", "think", "move", "removal", "render", "hud", "flip"]
+    def __init__(self, history = 600, keepAll = False):
+        self.enabled = True
+        self.history = collections.deque(maxlen = history)
+        self.allFrames = None
+        if keepAll:
+            self.allFrames = []
+        self.current = dict.fromkeys(self.phases, 0.0)
+        self.byClass = {}
+    def add(self, phase, seconds):
+        self.current[phase] += seconds
+    def addEntity(self, kind, name, seconds):
+        key = (kind, name)
+        entry = self.byClass.get(key)
+        if entry is None:
+            entry = self.byClass[key] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+    def endFrame(self, idle = False):
+        frame = (tuple([self.current[phase] for phase in self.phases]), idle)
+        self.history.append(frame)
+        if self.allFrames is not None:
+            self.allFrames.append(frame)
+        self.current = dict.fromkeys(self.phases, 0.0)
+    def busy(self, frames):
+        return [frame for frame, idle in frames if not idle]
+    def percentiles(self, frames = None):
+        if frames is None: frames = self.history
+        totals = sorted([sum(frame) for frame in self.busy(frames)])
+        if not totals: return {}
+        pick = lambda fraction: totals[min(len(totals) - 1, int(fraction * len(totals)))]
+        return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": totals[-1]}
+    def summary(self):
+        frames = self.allFrames
+        if frames is None: frames = list(self.history)
+        busy = self.busy(frames)
+        count = max(1, len(busy))
+        phaseMeans = {}
+        for index, phase in enumerate(self.phases):
+            phaseMeans[phase] = sum([frame[index] for frame in busy]) / count
+        entities = []
+        for (kind, name), (calls, total) in sorted(self.byClass.items(), key = lambda item: -item[1][1]):
+            entities.append({"kind": kind, "class": name, "calls": calls, "total": total, "mean": total / max(1, calls)})
+        return {"frames": len(frames), "idleFrames": len(frames) - len(busy), "percentiles": self.percentiles(frames), "phaseMeans": phaseMeans, "entities": entities,\
+                "pools": poolStats()}
+    def dump(self, basename):
+        # basename.json gets the summary, basename.csv one row per frame
+        f = open(basename + ".json", "w")
+        json.dump(self.summary(), f, indent = 2, sort_keys = True)
+        f.close()
+        frames = self.allFrames
+        if frames is None: frames = list(self.history)
+        f = open(basename + ".csv", "w")
+        f.write("frame,idle,total,%s\n" % ",".join(self.phases))
+        for index, (frame, idle) in enumerate(frames):
+            f.write("%s,%d,%s,%s\n" % (index, idle, sum(frame), ",".join([repr(value) for value in frame])))
+        f.close()
+
+class ProfilerOverlay:
+    # redrawn from the profiler every refreshFrames frames so it doesn't cost
+    # much more than the things it's measuring
+    def __init__(self, profiler, refreshFrames = 30):
+        self.profiler = profiler
+        self.refreshFrames = refreshFrames
+        self.frame = 0
+        self.lines = []
+    def refresh(self):
+        lines = []
+        percentiles = self.profiler.percentiles()
+        if percentiles:
+            lines.append("frame ms p50 %.2f p90 %.2f p99 %.2f max %.2f" % (percentiles["p50"] * 1000.0,\
+                         percentiles["p90"] * 1000.0, percentiles["p99"] * 1000.0, percentiles["max"] * 1000.0))
+        frames = self.profiler.busy(self.profiler.history)
+        count = max(1, len(frames))
+        for index, phase in enumerate(self.profiler.phases):
+            lines.append("%s %.2fms" % (phase, 1000.0 * sum([frame[index] for frame in frames]) / count))
+        worst = sorted(self.profiler.byClass.items(), key = lambda item: -item[1][1])[:8]
+        for (kind, name), (calls, total) in worst:
+            lines.append("%s %s %.3fms/call" % (name, kind, 1000.0 * total / max(1, calls)))
+        budget = getParticleBudget()
+        lines.append("detail %.2f particles %s/%s" % (budget.detail, budget.used, int(budget.limit * budget.detail)))
+        for name, stats in sorted(poolStats().items()):
+            lines.append("%s pool %s hits %s misses %s spare" % (name, stats["hits"], stats["misses"], stats["spare"]))
+        while len(self.lines) < len(lines):
+            self.lines.append(HudText(10, (0,255,255)))
+        for hudText, text in zip(self.lines, lines):
+            hudText.update(text)
+        self.lines = self.lines[:len(lines)]
+    def render(self, dest):
+        if self.frame % self.refreshFrames == 0:
+            self.refresh()
+        self.frame += 1
+        drawn = []
+        width, height = dest.get_size()
+        y = 40
+        for hudText in self.lines:
+            surface = hudText.surface
+            drawn.append(dest.blit(surface, (width - surface.get_size()[0] - 5, y)))
+            y += 11
+        return drawn
+
+def setProfiler(profiler):
+    global __profiler
+    __profiler = profiler
+
+def getProfiler():
+    # None unless a profiler is installed and switched on
+    global __profiler
+    if __profiler is not None and __profiler.enabled:
+        return __profiler
+    return None
 
 def getResolution():
     global __screenResolution
@@ -20,17 +314,23 @@ def isFullscreen():
     global __fullscreenValue
     return __fullscreenValue
 
+def useDirtyRects():
+    global __dirtyRectsValue
+    return __dirtyRectsValue
+
 def loadGraphicsSettings():
     global __screenResolution
     global __fullscreenValue
-    settings = INIFile("settings.ini")
-    settings.readonly = False # generate new file if needed
+    global __dirtyRectsValue
+    settings = getSettings()
     if not settings.hasValue("graphics", "width"):
         settings.makeValue("graphics", "width", 800)
     if not settings.hasValue("graphics", "height"):
         settings.makeValue("graphics", "height", 600)
     if not settings.hasValue("graphics", "fullscreen"):
         settings.makeValue("graphics", "fullscreen", "False")
+    if not settings.hasValue("graphics", "dirtyRects"):
+        settings.makeValue("graphics", "dirtyRects", "False")
     width = int(settings.getValue("graphics","width"))
     height = int(settings.getValue("graphics","height"))
     __screenResolution = (width, height)
@@ -38,30 +338,108 @@ def loadGraphicsSettings():
         __fullscreenValue = True
     else:
         __fullscreenValue = False
-    settings.save()
+    __dirtyRectsValue = (settings.getValue("graphics","dirtyRects") == "True")
+
+def getSettings():
+    # settings.ini is read once and shared, changes are written out by a
+    # SettingsWriter in the background. call flushSettings() before exiting
+    global __settings
+    if __settings is None:
+        __settings = INIFile("settings.ini")
+        __settings.readonly = False # generate new file if needed
+    return __settings
+
+def flushSettings():
+    global __settings
+    if __settings is None: return
+    if __settings.writer is not None:
+        __settings.writer.stop()
+        __settings.writer = None
+    if __settings.dirty:
+        __settings.save()
+
+def replaceFile(source, dest):
+    # os.rename won't replace an existing file on Windows
+    replace = getattr(os, "replace", None)
+    if replace is not None:
+        replace(source, dest)
+        return
+    if os.name == "nt" and os.path.exists(dest):
+        os.remove(dest)
+    os.rename(source, dest)
+
+class SettingsWriter(threading.Thread):
+    # saves a while after the last change rather than on every one, so a run
+    # of new high scores costs one write and none of them on the game thread
+    def __init__(self, settings, delay = 2.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.settings = settings
+        self.delay = delay
+        self.wake = threading.Condition()
+        self.lastChange = None
+        self.stopping = False
+    def changed(self):
+        self.wake.acquire()
+        self.lastChange = timer()
+        self.wake.notify()
+        self.wake.release()
+    def stop(self):
+        # anything still waiting is left for the caller to save
+        self.wake.acquire()
+        self.stopping = True
+        self.wake.notify()
+        self.wake.release()
+        self.join()
+    def run(self):
+        while True:
+            self.wake.acquire()
+            while self.lastChange is None and not self.stopping:
+                self.wake.wait()
+            if self.stopping:
+                self.wake.release()
+                return
+            remaining = self.lastChange + self.delay - timer()
+            if remaining > 0:
+                self.wake.wait(remaining)
+                self.wake.release()
+                continue
+            self.lastChange = None
+            self.wake.release()
+            self.settings.save()
 
 class INIFile():
     def __init__(self, filename, readonly = False):
         self.sections = {}
         self.filename = filename
         self.readonly = readonly
+        self.dirty = False
+        self.writer = None
+        self.lock = threading.Lock()
         if not self.load():
-            print "error loading '%s'" % filename
-    def __del__(self):
-        self.save()
+            print("error loading '%s'" % filename)
     def hasSection(self, name):
-        return (name in self.sections.iterkeys())
+        return (name in self.sections)
     def hasValue(self, section, name):
         if not self.hasSection(section): return False
-        return (name in self.sections[section].iterkeys())
+        return (name in self.sections[section])
     def getValue(self, section, name):
         if not self.hasValue(section, name):
             return None
         return self.sections[section][name]
     def makeValue(self, section, name, value = None):
+        self.lock.acquire()
         if not self.hasSection(section):
             self.sections[section] = {}
         self.sections[section][name] = value
+        self.dirty = True
+        self.lock.release()
+        if self.readonly: return
+        if self.writer is None:
+            # started on the first change, so read only settings never have one
+            self.writer = SettingsWriter(self)
+            self.writer.start()
+        self.writer.changed()
     def load(self):
         storeReadOnly = self.readonly
         self.readonly = True # if loading breaks, don't save
@@ -71,6 +449,7 @@ class INIFile():
         except:
             return False # error here
         lines = f.read().split("\n")
+        f.close()
         for x in range(len(lines)):
             if lines[x].find("#") != -1:
                 lines[x] = lines[x][:lines[x].find("#")]
@@ -97,22 +476,44 @@ class INIFile():
         self.readonly = storeReadOnly
         return True
     def save(self):
+        # written to a temporary file and renamed over the old one, so a crash
+        # part way through never leaves a half written settings file
         if self.readonly: return False
-        f = None
+        self.lock.acquire()
+        text = []
+        for name, values in self.sections.items():
+            text.append("[%s]\n" % name)
+            for valName, value in values.items():
+                text.append("%s=%s\n" % (valName, value))
+        self.dirty = False
+        self.lock.release()
+        tempName = self.filename + ".tmp"
         try:
-            f = open(self.filename, "w")
-        except:
+            f = open(tempName, "w")
+            f.write("".join(text))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            replaceFile(tempName, self.filename)
+        except (IOError, OSError):
+            self.dirty = True
             return False # error here
-        for name, values in self.sections.iteritems():
-            f.write("[%s]\n" % name)
-            for valName, value in values.iteritems():
-                f.write("%s=%s\n" % (valName, value))
         return True
 
-class Vec2D:
+class Vec2D(object):
+    # positions and velocities are updated in place every tick, so hang on to
+    # the object rather than a copy if you want to see it move
+    __slots__ = ("x", "y")
     def __init__(self, x, y):
         self.x = x
         self.y = y
+    def set(self, x, y):
+        self.x = x
+        self.y = y
+    def __imul__(self, factor):
+        self.x *= factor
+        self.y *= factor
+        return self
     def getX(self):
         return self.x
     def getY(self):
@@ -122,7 +523,24 @@ class Vec2D:
     def getInt(self):
         return (int(self.x), int(self.y))
 
+class SimulationClock:
+    # simulation time only moves when the world ticks, a fixed step at a time,
+    # so timers don't care how long rendering took or whether there's a display
+    def __init__(self, tickRate = 60):
+        self.tickRate = tickRate
+        self.dt = 1.0 / tickRate
+        self.ticks = 0
+    def now(self):
+        return self.ticks * self.dt
+    def advance(self):
+        self.ticks += 1
+
 class Entity:
+    # (event type, key) pairs this gets notified of while it's in a registry,
+    # a key of None means every event of that type
+    subscriptions = []
+    system = "effects"
+    pool = None # where it goes back to once it's out of the registry
     def __init__(self, pos):
         self.removeMe = False
         self.renderBounds = ((-1,-1),(1,1))
@@ -132,6 +550,26 @@ class Entity:
         self.clipTo = None
         self.wrapAround = False
         self.vel = Vec2D(0,0)
+        self.lastPos = None
+        self.drawPos = None
+        self.wrapped = False
+        self.denseIndex = None # where it sits in its system's list, while it's registered
+    def reuse(self, x, y):
+        # back the way __init__ leaves it for a pooled entity, its vectors are
+        # set in place rather than made again. a last position on top of the
+        # current one sweeps and draws the same as not having moved yet
+        self.removeMe = False
+        self.renderBounds = ((-1,-1),(1,1))
+        self.pos.set(x, y)
+        self.friction = 1.0
+        self.actuallyClip = True
+        self.clipTo = None
+        self.wrapAround = False
+        self.vel.set(0, 0)
+        if self.lastPos is not None:
+            self.lastPos.set(x, y)
+        self.wrapped = False
+        self.denseIndex = None
     def setClipValues(self, topLeft, bottomRight, wrapAround = False, actuallyClip = True):
         self.clipTo = (topLeft, bottomRight)
         self.wrapAround = wrapAround
@@ -142,23 +580,61 @@ class Entity:
         pass
     def notify(self, event):
         pass
+    def removed(self):
+        # it's just left the registry, or was killed off before it got in
+        pass
+    def screenRect(self):
+        # what render() covers outside the sprite batch, entities without
+        # renderBounds are expected to draw everything through the batch
+        if self.renderBounds is None: return None
+        (lx, ly), (rx, ry) = self.renderBounds
+        return pygame.Rect(int(self.pos.x + lx) - 1, int(self.pos.y + ly) - 1, int(rx - lx) + 3, int(ry - ly) + 3)
+    def bounds(self):
+        # (left, top, right, bottom) of everything render() draws, including
+        # anything it draws on behalf of what it owns. None means anywhere
+        if self.renderBounds is None: return None
+        (lx, ly), (rx, ry) = self.renderBounds
+        x, y = self.pos.x, self.pos.y
+        return (x + lx, y + ly, x + rx, y + ry)
     def onScreen(self, topLeft, bottomRight):
-        if self.renderBounds is None: return True
-        x, y = self.pos.get()
-        x1, y1 = x + self.renderBounds[0][0], y + self.renderBounds[0][1]
-        x2, y2 = x + self.renderBounds[1][0], y + self.renderBounds[1][1]
-        lx, ly = topLeft
-        rx, ry = bottomRight
-        if (x1 >= lx and x1 <= rx) or (x2 >= lx and x2 <= rx):
-            if (y1 >= ly and y1 <= ry) or (y2 >= ly and y2 <= ry):
-                return True
-        return False
+        # this is tested where the entity's drawn this frame. anything that
+        # wrapped is drawn where it landed, so there's only ever one copy of
+        # it to test, even right on the edge
+        bounds = self.bounds()
+        if bounds is None: return True
+        return overlaps(bounds, topLeft, bottomRight)
+    def sweepStart(self):
+        # where the last move started from. anything that wrapped is swept in
+        # from just beyond the edge it came in at, not dragged back across the
+        # whole screen
+        if self.lastPos is None: return self.pos.get()
+        x, y = self.lastPos.x, self.lastPos.y
+        if self.wrapped:
+            (lx, ly), (rx, ry) = self.clipTo
+            width, height = rx - lx, ry - ly
+            if x - self.pos.x > width / 2.0: x -= width
+            elif self.pos.x - x > width / 2.0: x += width
+            if y - self.pos.y > height / 2.0: y -= height
+            elif self.pos.y - y > height / 2.0: y += height
+        return x, y
+    def interpolated(self, alpha):
+        # where to draw between the last tick and this one, anything that just
+        # wrapped across the screen is drawn where it landed
+        if self.lastPos is None or self.wrapped: return self.pos
+        lx, ly = self.lastPos.x, self.lastPos.y
+        if self.drawPos is None:
+            self.drawPos = Vec2D(0,0)
+        self.drawPos.set(lx + (self.pos.x - lx) * alpha, ly + (self.pos.y - ly) * alpha)
+        return self.drawPos
     def move(self):
-        mX, mY = self.vel.get()
-        newX = self.pos.getX() + mX
-        newY = self.pos.getY() + mY
+        pos = self.pos
+        vel = self.vel
+        newX = pos.x + vel.x
+        newY = pos.y + vel.y
+        self.wrapped = False
         if self.clipTo is not None and self.actuallyClip:
             if self.wrapAround:
+                wrapX, wrapY = newX, newY
                 if newX < self.clipTo[0][0]:
                     newX = self.clipTo[1][0]
                 elif newX > self.clipTo[1][0]:
@@ -167,6 +643,7 @@ class Entity:
                     newY = self.clipTo[1][1]
                 elif newY > self.clipTo[1][1]:
                     newY = self.clipTo[0][1]
+                self.wrapped = (newX != wrapX or newY != wrapY)
             else:
                 if newX < self.clipTo[0][0]:
                     newX = self.clipTo[0][0]
@@ -176,236 +653,705 @@ class Entity:
                     newY = self.clipTo[0][1]
                 elif newY > self.clipTo[1][1]:
                     newY = self.clipTo[1][1]
-        self.pos = Vec2D(newX, newY)
-        self.vel = Vec2D(mX * self.friction, mY * self.friction)
+        if self.lastPos is None:
+            self.lastPos = Vec2D(pos.x, pos.y)
+        else:
+            self.lastPos.set(pos.x, pos.y)
+        pos.set(newX, newY)
+        vel *= self.friction
+
+# swept queries with this many candidate rows or fewer are done one row at a
+# time, below that numpy's per-call overhead costs more than the arithmetic
+SWEEP_SCALAR_ROWS = 24
+
+# the world updates and draws entities a system at a time, in this order
+SYSTEMS = ["controllers", "asteroids", "projectiles", "effects", "overlays"]
+
+class EntityRegistry:
+    # entities sit in a dense list per system for iteration, each one
+    # remembers its index so removal swaps the last entry into the gap.
+    # spawn() and despawn() only queue the change, flush() applies it at the
+    # end of a tick. entities are subscribed to the bus, if there is one, while
+    # they're in here
+    def __init__(self, entities = [], bus = None):
+        self.systems = [[] for name in SYSTEMS]
+        self.systemIndex = dict([(name, index) for index, name in enumerate(SYSTEMS)])
+        self.toSpawn = []
+        self.toDespawn = []
+        self.bus = bus
+        for entity in entities:
+            self.add(entity)
+    def __iter__(self):
+        return itertools.chain(*self.systems)
+    def __len__(self):
+        return sum([len(dense) for dense in self.systems])
+    def system(self, name):
+        return self.systems[self.systemIndex[name]]
+    def spawn(self, entity):
+        self.toSpawn.append(entity)
+    def despawn(self, entity):
+        self.toDespawn.append(entity)
+    def add(self, entity):
+        dense = self.system(entity.system)
+        entity.denseIndex = len(dense)
+        dense.append(entity)
+        if self.bus is not None and entity.subscriptions:
+            self.bus.subscribe(entity, entity.subscriptions)
+    def remove(self, entity):
+        if entity.denseIndex is None: return
+        dense = self.system(entity.system)
+        last = dense.pop()
+        if last is not entity:
+            last.denseIndex = entity.denseIndex
+            dense[entity.denseIndex] = last
+        entity.denseIndex = None
+        if self.bus is not None and entity.subscriptions:
+            self.bus.unsubscribe(entity, entity.subscriptions)
+        entity.removed()
+        if entity.pool is not None:
+            entity.pool.release(entity)
+    def flush(self):
+        for entity in self.toDespawn:
+            self.remove(entity)
+        for entity in self.toSpawn:
+            # something can be spawned and killed off within the same tick
+            if not entity.removeMe:
+                self.add(entity)
+                continue
+            entity.removed()
+            if entity.pool is not None:
+                entity.pool.release(entity)
+        self.toDespawn = []
+        self.toSpawn = []
+
+class EventBus:
+    # listeners keyed by (event type, key), so handing out an event costs a
+    # couple of lookups whatever is in the world and nothing at all for the
+    # types nobody listens to
+    def __init__(self):
+        self.listeners = {}
+    def subscribe(self, listener, subscriptions):
+        for subscription in subscriptions:
+            if subscription in self.listeners:
+                self.listeners[subscription].append(listener)
+            else:
+                self.listeners[subscription] = [listener]
+    def unsubscribe(self, listener, subscriptions):
+        for subscription in subscriptions:
+            listeners = self.listeners.get(subscription)
+            if listeners is None or listener not in listeners: continue
+            listeners.remove(listener)
+            if not listeners:
+                del self.listeners[subscription]
+    def dispatch(self, event):
+        listeners = self.listeners.get((event.type, None))
+        if listeners is not None:
+            for listener in listeners:
+                listener.notify(event)
+        key = getattr(event, "key", None)
+        if key is not None:
+            listeners = self.listeners.get((event.type, key))
+            if listeners is not None:
+                for listener in listeners:
+                    listener.notify(event)
+
+class SpatialHash:
+    # uniform grid over the area things wrap around in. rows are filed by
+    # centre and sorted by cell, so cells are contiguous slices of self.order
+    # and a run of cells along one grid row is a single slice. queries pad
+    # their search by the largest size filed
+    def __init__(self, topLeft, bottomRight, cellSize = 64):
+        self.left, self.top = topLeft
+        right, bottom = bottomRight
+        self.cellSize = float(cellSize)
+        self.cols = max(1, int(math.ceil((right - self.left) / self.cellSize)))
+        self.rows = max(1, int(math.ceil((bottom - self.top) / self.cellSize)))
+        self.clear()
+    def cellOf(self, x, y):
+        # wrapped rows always sit inside the clip area after a move, but
+        # anything that hasn't moved yet is clamped onto the edge cells
+        cx = int((x - self.left) / self.cellSize)
+        cy = int((y - self.top) / self.cellSize)
+        if cx < 0: cx = 0
+        elif cx >= self.cols: cx = self.cols - 1
+        if cy < 0: cy = 0
+        elif cy >= self.rows: cy = self.rows - 1
+        return cx, cy
+    def clear(self):
+        self.order = numpy.zeros(0, dtype=numpy.intp)
+        self.starts = numpy.zeros(self.cols * self.rows + 1, dtype=numpy.intp)
+        self.largest = 0
+    def rebuild(self, positions, sizes):
+        if len(positions) == 0:
+            self.clear()
+            return
+        cx = ((positions[:, 0] - self.left) / self.cellSize).astype(numpy.intp)
+        cy = ((positions[:, 1] - self.top) / self.cellSize).astype(numpy.intp)
+        numpy.clip(cx, 0, self.cols - 1, out=cx)
+        numpy.clip(cy, 0, self.rows - 1, out=cy)
+        keys = cy * self.cols + cx
+        self.order = numpy.argsort(keys, kind="mergesort")
+        self.starts[0] = 0
+        numpy.cumsum(numpy.bincount(keys, minlength=self.cols * self.rows), out=self.starts[1:])
+        self.largest = int(sizes.max())
+    def candidates(self, x, y, reach):
+        lx, ly = self.cellOf(x - reach, y - reach)
+        rx, ry = self.cellOf(x + reach, y + reach)
+        found = []
+        for cy in range(ly, ry + 1):
+            first = self.starts[cy * self.cols + lx]
+            last = self.starts[cy * self.cols + rx + 1]
+            if last > first:
+                found.append(self.order[first:last])
+        if not found: return self.order[:0]
+        if len(found) == 1: return found[0]
+        return numpy.concatenate(found)
 
 class EntitySpawner(Entity):
-    def __init__(self, pos, factory, delayRange, maximum):
+    # asks the factory for another one every so often, as long as fewer than
+    # maximum of the ones it made are still around
+    system = "controllers"
+    def __init__(self, pos, factory, delayRange, maximum, clock):
         Entity.__init__(self, pos)
-        self.made = []
+        self.clock = clock
         self.maximum = maximum
         self.factory = factory
         self.delay = delayRange
-        self.nextDelay = random.randint(self.delay[0], self.delay[1]) / 1000.0
-        self.last = time.clock()
+        self.nextDelay = randint(self.delay[0], self.delay[1]) / 1000.0
+        self.last = self.clock.now()
         self.renderBounds = None
-    def spawn(self):
-        make = self.factory.make(self)
-        self.made.append(make)
-        return make
     def think(self, others, context):
         self.factory.think(others, context)
-        if time.clock() >= self.last + self.nextDelay and len(self.made) < self.maximum:
-            others.append(self.spawn())
-            self.nextDelay = random.randint(self.delay[0], self.delay[1]) / 1000.0
-            self.last = time.clock()
-        toRemove = []
-        for each in self.made:
-            if each.removeMe:
-                toRemove.append(each)
-        for each in toRemove:
-            self.made.remove(each)
+        if self.clock.now() >= self.last + self.nextDelay and self.factory.population() < self.maximum:
+            self.factory.make(self)
+            self.nextDelay = randint(self.delay[0], self.delay[1]) / 1000.0
+            self.last = self.clock.now()
     def render(self, dest):
         self.factory.render(dest)
 
 class DebugEntity(Entity):
     def __init__(self, pos):
         Entity.__init__(self, pos)
-        self.renderBounds = None
+        self.renderBounds = ((0,0),(32,32))
     def render(self, dest):
         pygame.draw.rect(dest, (255,0,255), (self.pos.get(), (32,32)))
 
-class Asteroid(Entity):
-    def __init__(self, pos, size, bearing, theEmitter):
-        Entity.__init__(self, pos)
-        self.theEmitter = theEmitter
-        self.maxSize = size
-        self.size = size
+class AsteroidField(Entity):
+    # every asteroid lives in a row of parallel arrays, like the particles in
+    # ParticleEmitter. the first self.count rows are in use, rows shot to
+    # pieces are marked dead and only compacted away in move(), so row numbers
+    # from a query stay good for the rest of the tick. rows added since the
+    # index was last rebuilt are checked by queries without it
+    system = "asteroids"
+    def __init__(self, margin, clock, capacity = 64):
+        Entity.__init__(self, Vec2D(0,0))
+        self.clock = clock
+        self.renderBounds = None
         self.speed = 0.5
-        mx = math.cos(bearing) * self.speed
-        my = math.sin(bearing) * self.speed
-        self.vel = Vec2D(mx, my)
-        self.renderBounds = ((-self.size,-self.size), (self.size, self.size))
-    def dead(self):
-        isDead = (self.size < 8)
-        if isDead: self.removeMe = True
-        return isDead
-    def getShot(self):
-        partCount = random.randint(5,20)
-        for x in range(partCount):
-            myX, myY = self.pos.get()
-            self.theEmitter.pos = Vec2D(myX, myY)
-            theAngle = random.randint(1,360)*math.pi/180
-            thePower = random.randint(50,100)/10.0
-            self.theEmitter.setDirection(theAngle, thePower)
-            self.theEmitter.emit()
-        self.size = self.size / 2
-        self.renderBounds = ((-self.size,-self.size), (self.size, self.size))
-        return self.dead()
+        self.minimumSize = 8
+        self.colour = (50,50,50)
+        self.count = 0
+        self.indexed = 0
+        self.alpha = 1.0
+        self.positions = numpy.zeros((capacity, 2))
+        self.lastPositions = numpy.zeros((capacity, 2))
+        self.velocities = numpy.zeros((capacity, 2))
+        self.sizes = numpy.zeros(capacity, dtype=numpy.intp)
+        self.maxSizes = numpy.zeros(capacity, dtype=numpy.intp)
+        self.spawned = numpy.zeros(capacity, dtype=bool)
+        self.dead = numpy.zeros(capacity, dtype=bool)
+        self.wrapped = numpy.zeros(capacity, dtype=bool)
+        self.emitter = ParticleEmitter(Vec2D(0,0), 200, None, [1,6], [200,700], [(50,50,50),(100,100,100),(255,128,0)], clock)
+        self.setMargin(margin)
+    def setMargin(self, margin):
+        # asteroids wrap once they're margin past the edge of the screen
+        width, height = getResolution()
+        self.left, self.top = -margin, -margin
+        self.right, self.bottom = width + margin, height + margin
+        self.index = SpatialHash((self.left, self.top), (self.right, self.bottom), margin * 2)
+        self.indexed = 0
+    def population(self):
+        # asteroids that came from the spawner rather than breaking off another
+        count = self.count
+        return int(numpy.count_nonzero(self.spawned[:count] & ~self.dead[:count]))
+    def grow(self):
+        capacity = len(self.sizes) * 2
+        for name in ["positions", "lastPositions", "velocities"]:
+            old = getattr(self, name)
+            new = numpy.zeros((capacity, 2))
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+        for name in ["sizes", "maxSizes", "spawned", "dead", "wrapped"]:
+            old = getattr(self, name)
+            new = numpy.zeros(capacity, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+    def add(self, x, y, size, bearing, spawned = False):
+        if self.count == len(self.sizes):
+            self.grow()
+        row = self.count
+        self.positions[row] = (x, y)
+        self.lastPositions[row] = (x, y)
+        self.velocities[row] = (math.cos(bearing) * self.speed, math.sin(bearing) * self.speed)
+        self.sizes[row] = size
+        self.maxSizes[row] = size
+        self.spawned[row] = spawned
+        self.dead[row] = False
+        self.wrapped[row] = False
+        self.count += 1
+        return row
+    def wrapPoint(self, x, y):
+        if x < self.left: x = self.right
+        elif x > self.right: x = self.left
+        if y < self.top: y = self.bottom
+        elif y > self.bottom: y = self.top
+        return x, y
+    def shoot(self, row):
+        # throws off some debris and breaks the asteroid in two, each half
+        # flying off in opposite directions. returns True if it was destroyed
+        x, y = self.positions[row].tolist()
+        self.emitter.pos.set(x, y)
+        partCount = randint(5,20)
+        for part in range(partCount):
+            theAngle = randint(1,360)*math.pi/180
+            thePower = randint(50,100)/10.0
+            self.emitter.setDirection(theAngle, thePower)
+            self.emitter.emit()
+        size = int(self.sizes[row]) // 2
+        self.sizes[row] = size
+        newBearing = randint(1,360) * math.pi / 180
+        if size < self.minimumSize:
+            self.dead[row] = True
+            return True
+        self.add(x, y, size, newBearing)
+        newBearing += math.pi
+        self.velocities[row] = (math.cos(newBearing) * self.speed, math.sin(newBearing) * self.speed)
+        return False
+    def rebuildIndex(self):
+        self.index.rebuild(self.positions[:self.count], self.sizes[:self.count])
+        self.indexed = self.count
+    def candidates(self, x, y, reach):
+        rows = self.index.candidates(x, y, reach)
+        if self.indexed < self.count:
+            rows = numpy.concatenate((rows, numpy.arange(self.indexed, self.count)))
+        return rows
+    def queryRadius(self, pos, radius):
+        # rows whose centre is within radius of pos, and their distances
+        x, y = pos.get()
+        rows = self.candidates(x, y, radius)
+        rows = rows[~self.dead[rows]]
+        dx = x - self.positions[rows, 0]
+        dy = y - self.positions[rows, 1]
+        distances = numpy.sqrt(dx*dx + dy*dy)
+        near = distances < radius
+        return rows[near], distances[near]
+    def querySwept(self, start, end, radius):
+        # rows a circle touched on its way from start to end over the last
+        # move, earliest first. each asteroid is taken to have come from
+        # its position less its velocity, so both movements are swept together
+        sx, sy = start
+        ex, ey = end
+        reach = math.hypot(ex - sx, ey - sy) / 2 + self.speed + radius + self.index.largest
+        rows = self.candidates((sx + ex) / 2.0, (sy + ey) / 2.0, reach)
+        if len(rows) <= SWEEP_SCALAR_ROWS:
+            return self.querySweptRows(rows.tolist(), sx, sy, ex, ey, radius)
+        rows = rows[~self.dead[rows]]
+        ax = self.positions[rows, 0]
+        ay = self.positions[rows, 1]
+        # relative to the asteroid the circle goes from d0 to d0 + motion
+        d0x = sx - (ax - self.velocities[rows, 0])
+        d0y = sy - (ay - self.velocities[rows, 1])
+        motionX = (ex - ax) - d0x
+        motionY = (ey - ay) - d0y
+        reach = radius + self.sizes[rows]
+        a = motionX*motionX + motionY*motionY
+        b = d0x*motionX + d0y*motionY
+        c = d0x*d0x + d0y*d0y - reach*reach
+        disc = b*b - a*c
+        times = numpy.zeros(len(rows))
+        # already touching at the start, or closing in and touching by the end
+        touching = c <= 0
+        closing = ~touching & (b < 0) & (disc >= 0)
+        times[closing] = (-b[closing] - numpy.sqrt(disc[closing])) / a[closing]
+        hit = touching | (closing & (times <= 1.0))
+        rows = rows[hit]
+        return rows[numpy.argsort(times[hit], kind="mergesort")]
+    def querySweptRows(self, rows, sx, sy, ex, ey, radius):
+        # the same test as querySwept a row at a time, for the handful of rows
+        # near one bullet
+        positions, velocities, sizes, dead = self.positions, self.velocities, self.sizes, self.dead
+        hits = []
+        for row in rows:
+            if dead.item(row): continue
+            ax, ay = positions.item(row, 0), positions.item(row, 1)
+            d0x = sx - (ax - velocities.item(row, 0))
+            d0y = sy - (ay - velocities.item(row, 1))
+            motionX = (ex - ax) - d0x
+            motionY = (ey - ay) - d0y
+            reach = radius + sizes.item(row)
+            c = d0x*d0x + d0y*d0y - reach*reach
+            if c <= 0:
+                hits.append((0.0, row))
+                continue
+            b = d0x*motionX + d0y*motionY
+            if b >= 0: continue
+            a = motionX*motionX + motionY*motionY
+            disc = b*b - a*c
+            if disc < 0: continue
+            hitTime = (-b - math.sqrt(disc)) / a
+            if hitTime <= 1.0:
+                hits.append((hitTime, row))
+        hits.sort(key = lambda hit: hit[0])
+        return [row for hitTime, row in hits]
+    def think(self, others, context):
+        self.emitter.think(others, context)
+    def compact(self):
+        count = self.count
+        alive = numpy.flatnonzero(~self.dead[:count])
+        if len(alive) == count: return
+        count = len(alive)
+        for name in ["positions", "lastPositions", "velocities", "sizes", "maxSizes", "spawned", "wrapped"]:
+            array = getattr(self, name)
+            array[:count] = array[alive]
+        self.dead[:count] = False
+        self.count = count
+        self.indexed = 0
+    def move(self):
+        self.compact()
+        count = self.count
+        if count == 0: return
+        positions = self.positions[:count]
+        self.lastPositions[:count] = positions
+        positions += self.velocities[:count]
+        wrapped = self.wrapped[:count]
+        wrapped[:] = False
+        for axis, low, high in [(positions[:, 0], self.left, self.right), (positions[:, 1], self.top, self.bottom)]:
+            under = axis < low
+            over = axis > high
+            axis[under] = high
+            axis[over] = low
+            wrapped |= under
+            wrapped |= over
+    def interpolated(self, alpha):
+        # each row is interpolated as it's drawn, the field itself never moves
+        self.alpha = alpha
+        return self.pos
     def render(self, dest):
-        pygame.draw.circle(dest, (50,50,50), self.pos.getInt(), self.size)
+        self.emitter.render(dest)
+        count = self.count
+        if count == 0: return
+        width, height = getResolution()
+        last = self.lastPositions[:count]
+        positions = last + (self.positions[:count] - last) * self.alpha
+        wrapped = self.wrapped[:count]
+        positions[wrapped] = self.positions[:count][wrapped]
+        sizes = self.sizes[:count]
+        xs = positions[:, 0]
+        ys = positions[:, 1]
+        visible = ~self.dead[:count] & (xs + sizes >= 0) & (xs - sizes <= width) & (ys + sizes >= 0) & (ys - sizes <= height)
+        sizes = sizes[visible]
+        xs = (xs[visible].astype(numpy.intp) - sizes).tolist()
+        ys = (ys[visible].astype(numpy.intp) - sizes).tolist()
+        sprites = {}
+        for size in set(sizes.tolist()):
+            sprites[size] = circleSprite(size, self.colour)
+        drawSprites(dest, [(sprites[size], (x, y)) for x, y, size in zip(xs, ys, sizes.tolist())])
 
 class AsteroidFactory(Entity):
     def __init__(self, thePlayer):
         self.player = thePlayer
         self.asteroidSize = 32
-        self.emitter = ParticleEmitter(Vec2D(0,0), 200, None, [1,6], [200,700], [(50,50,50),(100,100,100),(255,128,0)])
+        self.field = AsteroidField(self.asteroidSize, thePlayer.clock)
+    def population(self):
+        return self.field.population()
     def make(self, spawner):
-        width, height = getResolution()
+        # somewhere far off the screen, so it wraps round onto one of the edges
         px, py = self.player.pos.get()
-        someAngle = random.randint(1,360) * math.pi / 180.0
+        someAngle = randint(1,360) * math.pi / 180.0
         distance = 4000.0 # extreme
         px += math.cos(someAngle) * distance
         py += math.sin(someAngle) * distance
-        newAsteroid = Asteroid(Vec2D(px,py), self.asteroidSize, random.randint(0,359) * math.pi / 180.0, self.emitter)
-        newAsteroid.setClipValues((-self.asteroidSize,-self.asteroidSize),(width+self.asteroidSize,height+self.asteroidSize),True)
-        newAsteroid.move()
-        return newAsteroid
-    def think(self, others, context):
-        self.emitter.think(others, context)
-    def render(self, dest):
-        self.emitter.render(dest)
+        bearing = randint(0,359) * math.pi / 180.0
+        px, py = self.field.wrapPoint(px + math.cos(bearing) * self.field.speed, py + math.sin(bearing) * self.field.speed)
+        return self.field.add(px, py, self.asteroidSize, bearing, True)
 
-class Particle(Entity):
-    def __init__(self, pos, vel, col, size, lifetime):
-        Entity.__init__(self, pos)
-        self.col = col
-        self.vel = vel
-        self.size = size
-        self.renderBounds = ((-self.size,-self.size),(self.size,self.size))
-        self.life = lifetime
-        self.friction = 0.999
-        self.start = time.clock()
-    def dead(self):
-        return (time.clock() > self.start + self.life)
-    def render(self, dest):
-        pygame.draw.circle(dest, self.col, self.pos.getInt(), int(self.size))
+class ParticleBudget:
+    # one limit on live particles shared by every emitter, scaled by a detail
+    # level from 0 to 1 that a DetailController turns down when frames run
+    # long. lower detail keeps fewer of the particles emitted, keeps them for
+    # less time and lets the laser sight look for hits less often
+    minimumDetail = 0.25
+    def __init__(self, limit = 3000):
+        self.limit = limit
+        self.used = 0
+        self.detail = 1.0
+    def admit(self, emitter):
+        if self.used >= self.limit * self.detail: return False
+        # every emitter keeps its share of what it emits rather than the
+        # first ones to fire taking everything
+        emitter.credit += self.detail
+        if emitter.credit < 1.0: return False
+        emitter.credit -= 1.0
+        return True
+    def lifetimeScale(self):
+        return 0.5 + 0.5 * self.detail
+    def sightInterval(self):
+        # ticks between laser sight hit tests
+        if self.detail >= 0.75: return 1
+        if self.detail >= 0.5: return 2
+        return 4
+
+__particleBudget = ParticleBudget()
+
+def getParticleBudget():
+    global __particleBudget
+    return __particleBudget
+
+class DetailController:
+    # watches how long the main loop spends on each frame and moves the
+    # particle budget's detail level, down quickly when frames take more
+    # than the target and back up slowly once there's plenty to spare
+    def __init__(self, budget, target, window = 30):
+        self.budget = budget
+        self.target = target # seconds of work a frame can take
+        self.window = window
+        self.frames = []
+    def frame(self, seconds):
+        self.frames.append(seconds)
+        if len(self.frames) < self.window: return
+        frames = sorted(self.frames)
+        self.frames = []
+        # the slower frames are what show up as stutter, not the average
+        slow = frames[int(len(frames) * 0.9)]
+        budget = self.budget
+        if slow > self.target:
+            budget.detail = max(budget.minimumDetail, budget.detail * 0.8)
+        elif slow < self.target * 0.7:
+            budget.detail = min(1.0, budget.detail + 0.05)
 
 class ParticleEmitter(Entity):
-    def __init__(self, pos, maxPop, delayRange, sizeRange, lifeRange, colours):
+    # particles live in parallel arrays rather than one object each, the first
+    # self.count rows are alive and the rest is spare capacity
+    def __init__(self, pos, maxPop, delayRange, sizeRange, lifeRange, colours, clock):
         self.maxParticles = maxPop
+        self.clock = clock
         self.delayRange = delayRange
         self.sizeRange = sizeRange
         self.lifeRange = lifeRange
         self.renderBounds = None
         self.cols = colours
         self.pos = pos
-        self.particles = []
-        self.last = time.clock()
+        self.vel = Vec2D(0,0)
+        self.friction = 0.999
+        self.count = 0
+        self.positions = numpy.zeros((maxPop, 2))
+        self.velocities = numpy.zeros((maxPop, 2))
+        self.colours = numpy.zeros(maxPop, dtype=numpy.intp)
+        self.sizes = numpy.zeros(maxPop, dtype=numpy.intp)
+        self.expiries = numpy.zeros(maxPop)
+        self.box = None # bounds of every live particle, only kept while count > 0
+        self.spriteTable = None
+        self.credit = 0.0 # towards the next particle the budget lets through
+        self.reset(pos, clock)
+    def reset(self, pos, clock):
+        # empty again, keeping the arrays and sprites
+        self.pos = pos
+        self.clock = clock
+        self.clear()
+        self.last = self.clock.now()
         if self.delayRange is None:
             self.nextDelay = None
         else:
-            self.nextDelay = random.randint(delayRange[0], delayRange[1]) / 1000.0
+            self.nextDelay = randint(self.delayRange[0], self.delayRange[1]) / 1000.0
     def emit(self):
-        if len(self.particles) >= self.maxParticles:
-            return
-        nextCol = random.choice(self.cols)
-        nextSize = random.randint(self.sizeRange[0], self.sizeRange[1])
-        nextLife = random.randint(self.lifeRange[0], self.lifeRange[1])
+        # the random numbers are drawn whether the particle's kept or not, so
+        # neither a full emitter nor the detail level changes how the rest of
+        # the game plays out
+        colour = randrange(len(self.cols))
+        size = randint(self.sizeRange[0], self.sizeRange[1])
+        nextLife = randint(self.lifeRange[0], self.lifeRange[1])
         nextLife = nextLife/1000.0
-        nextPos = Vec2D(self.pos.getX(), self.pos.getY())
-        nextVel = Vec2D(self.vel.getX(), self.vel.getY())
-        particle = Particle(nextPos, nextVel, nextCol, nextSize, nextLife)
-        self.particles.append(particle)
-        self.last = time.clock()
+        self.last = self.clock.now()
         if self.nextDelay is not None:
-            self.nextDelay = random.randint(self.delayRange[0],\
+            self.nextDelay = randint(self.delayRange[0],\
                                             self.delayRange[1]) / 1000.0
+        if self.count >= self.maxParticles:
+            return
+        budget = getParticleBudget()
+        if not budget.admit(self):
+            return
+        index = self.count
+        self.colours[index] = colour
+        self.sizes[index] = size
+        self.positions[index] = self.pos.get()
+        self.velocities[index] = self.vel.get()
+        self.expiries[index] = self.last + nextLife * budget.lifetimeScale()
+        self.count += 1
+        budget.used += 1
+        x, y = self.pos.get()
+        particle = (x - size, y - size, x + size, y + size)
+        if self.count == 1:
+            self.box = particle
+        else:
+            self.box = unionBounds(self.box, particle)
+    def clear(self):
+        getParticleBudget().used -= self.count
+        self.count = 0
     def setDirection(self, angle, power):
         mx = math.cos(angle) * power
         my = math.sin(angle) * power
-        self.vel = Vec2D(mx,my)
+        self.vel.set(mx,my)
     def think(self, others, context):
-        toRemove = []
+        profiler = getProfiler()
+        if profiler is None:
+            self.advance()
+        else:
+            start = timer()
+            self.advance()
+            profiler.addEntity("think", "ParticleEmitter", timer() - start)
+    def advance(self):
         if self.nextDelay is not None:
-            if time.clock() > self.last + self.nextDelay:
+            if self.clock.now() > self.last + self.nextDelay:
                 self.emit()
-        for particle in self.particles:
-            if particle.dead() and particle not in toRemove:
-                toRemove.append(particle)
-                continue
-            particle.move()
-        for bad in toRemove:
-            self.particles.remove(bad)
+        count = self.count
+        if count == 0: return
+        alive = numpy.flatnonzero(self.expiries[:count] >= self.clock.now())
+        if len(alive) < count:
+            getParticleBudget().used -= count - len(alive)
+            count = len(alive)
+            self.positions[:count] = self.positions[alive]
+            self.velocities[:count] = self.velocities[alive]
+            self.colours[:count] = self.colours[alive]
+            self.sizes[:count] = self.sizes[alive]
+            self.expiries[:count] = self.expiries[alive]
+            self.count = count
+            if count == 0: return
+        self.positions[:count] += self.velocities[:count]
+        self.velocities[:count] *= self.friction
+        # padded by the biggest a particle can be rather than looking at sizes
+        pad = self.sizeRange[1]
+        low = self.positions[:count].min(axis=0).tolist()
+        high = self.positions[:count].max(axis=0).tolist()
+        self.box = (low[0] - pad, low[1] - pad, high[0] + pad, high[1] + pad)
+    def bounds(self):
+        return self.box
+    def onScreen(self, topLeft, bottomRight):
+        if self.count == 0: return False
+        return overlaps(self.box, topLeft, bottomRight)
+    def sprites(self):
+        # [colour index][size] lookup so render doesn't touch the shared cache
+        if self.spriteTable is None:
+            self.spriteTable = []
+            for col in self.cols:
+                row = [None] * (self.sizeRange[1] + 1)
+                for size in range(self.sizeRange[0], self.sizeRange[1] + 1):
+                    row[size] = circleSprite(size, col)
+                self.spriteTable.append(row)
+        return self.spriteTable
     def render(self, dest):
-        for part in self.particles:
-            part.render(dest)
+        profiler = getProfiler()
+        if profiler is None:
+            self.draw(dest)
+        else:
+            start = timer()
+            self.draw(dest)
+            profiler.addEntity("render", "ParticleEmitter", timer() - start)
+    def draw(self, dest):
+        # owners draw their emitters themselves, so the whole emitter is
+        # skipped here when none of it lands on dest
+        view = dest.get_clip()
+        if not self.onScreen(view.topleft, view.bottomright): return
+        count = self.count
+        table = self.sprites()
+        sizes = self.sizes[:count]
+        xs = (self.positions[:count, 0].astype(numpy.intp) - sizes).tolist()
+        ys = (self.positions[:count, 1].astype(numpy.intp) - sizes).tolist()
+        drawSprites(dest, [(table[col][size], (x, y)) for x, y, col, size in\
+                           zip(xs, ys, self.colours[:count].tolist(), sizes.tolist())])
 
 class MultiplierGraphic(Entity):
-    def __init__(self, pos, multiplier, size = 14):
-        Entity.__init__(self, pos)
+    def __init__(self, x, y, multiplier, clock, size = 14):
+        Entity.__init__(self, Vec2D(x, y))
+        self.reset(x, y, multiplier, clock, size)
+    def reset(self, x, y, multiplier, clock, size = 14):
+        self.reuse(x, y)
+        self.clock = clock
         self.lifeSpan = 2000.0
-        self.bornTime = time.clock()
+        self.bornTime = self.clock.now()
         self.multiplier = multiplier
         self.fontSize = size
-        tempFont = makeFont(self.fontSize)
-        self.rendered = tempFont.render("x%s" % self.multiplier, True, (0,255,0))
+        self.rendered = renderText("x%s" % self.multiplier, self.fontSize, (0,255,0))
         self.renderBounds = ((-1,-1), self.rendered.get_size())
-        angle = random.randint(1,360) * math.pi / 180.0
-        speed = random.randint(5,15) / 10.0
+        angle = randint(1,360) * math.pi / 180.0
+        speed = randint(5,15) / 10.0
         mx, my = math.cos(angle) * speed, math.sin(angle) * speed
-        self.vel = Vec2D(mx, my)
+        self.vel.set(mx, my)
     def think(self, others, context):
-        if time.clock() >= self.bornTime + (self.lifeSpan / 1000.0):
+        if self.clock.now() >= self.bornTime + (self.lifeSpan / 1000.0):
             self.removeMe = True
     def render(self, dest):
         dest.blit(self.rendered, (self.pos.get(), (0,0)))
 
+MultiplierGraphic.pool = makePool("MultiplierGraphic", MultiplierGraphic)
+
 class Bullet(Entity):
-    def __init__(self, pos, size, bearing, speed, thePlayer):
-        Entity.__init__(self, pos)
-        self.emitter = ParticleEmitter(self.pos, 200, [20,100], [1,2], [10,200], [(0,0,255), (50,50,255), (100,100,255)])
+    system = "projectiles"
+    lifespan = 1500 / 1000.0 # ms, divide by 1000.0 to get seconds
+    def __init__(self, x, y, size, bearing, speed, thePlayer):
+        Entity.__init__(self, Vec2D(x, y))
+        self.emitter = None
+        self.reset(x, y, size, bearing, speed, thePlayer)
+    def reset(self, x, y, size, bearing, speed, thePlayer):
+        self.reuse(x, y)
+        if self.emitter is None:
+            self.emitter = ParticleEmitter(self.pos, 200, [20,100], [1,2], [10,200], [(0,0,255), (50,50,255), (100,100,255)], thePlayer.clock)
+        else:
+            self.emitter.reset(self.pos, thePlayer.clock)
         self.thePlayer = thePlayer
         self.bearing = bearing
         self.size = size
-        self.timeBorn = time.clock()
-        self.lifespan = 1500 / 1000.0 # ms, divide by 1000.0 to get seconds
+        self.timeBorn = thePlayer.clock.now()
         self.renderBounds = ((-self.size,-self.size), (self.size, self.size))
         mx, my = math.cos(bearing) * speed, math.sin(bearing) * speed
-        self.vel = Vec2D(mx, my)
-    def collisionCheck(self, others):
-        for index in range(len(others)):
-            x = others[index]
-            if x is self: continue
-            if not isinstance(x, Asteroid): continue
-            mx, my = self.pos.get()
-            ox, oy = x.pos.get()
-            dx, dy = mx-ox, my-oy
-            distance = math.sqrt((dx*dx)+(dy*dy))
-            if distance <= self.size + x.size:
-                if time.clock() < self.thePlayer.spreeStart + (self.thePlayer.spreeTime / 1000.0):
-                    if self.thePlayer.scoreMultiplier < 10:
-                        self.thePlayer.scoreMultiplier += 1
-                    multiX, multiY = self.thePlayer.pos.get()
-                    others.append(MultiplierGraphic(Vec2D(multiX, multiY), self.thePlayer.scoreMultiplier))
-                else:
-                    self.thePlayer.scoreMultiplier = 1.0 # score multiplier back to zero after the spree
-                self.thePlayer.spreeStart = time.clock()
-                self.thePlayer.score += ((x.maxSize - x.size) + 1) * self.thePlayer.scoreMultiplier
-                itDied = x.getShot()
-                newBearing = random.randint(1,360) * math.pi / 180
-                px, py = x.pos.get()
-                if itDied == False:
-                    newAsteroid = Asteroid(Vec2D(px,py), x.size, newBearing, x.theEmitter)
-                    newBearing += math.pi
-                    mx, my = math.cos(newBearing) * x.speed, math.sin(newBearing) * x.speed
-                    x.vel = Vec2D(mx, my)
-                    others.append(newAsteroid)
-                self.removeMe = True
-                break
-            others[index] = x
+        self.vel.set(mx, my)
+    def collisionCheck(self, others, context):
+        asteroids = context.asteroids
+        for row in asteroids.querySwept(self.sweepStart(), self.pos.get(), self.size):
+            now = self.thePlayer.clock.now()
+            if now < self.thePlayer.spreeStart + (self.thePlayer.spreeTime / 1000.0):
+                if self.thePlayer.scoreMultiplier < 10:
+                    self.thePlayer.scoreMultiplier += 1
+                multiX, multiY = self.thePlayer.pos.get()
+                others.spawn(MultiplierGraphic.pool.acquire(multiX, multiY, self.thePlayer.scoreMultiplier, self.thePlayer.clock))
+            else:
+                self.thePlayer.scoreMultiplier = 1.0 # score multiplier back to zero after the spree
+            self.thePlayer.spreeStart = now
+            self.thePlayer.score += int((asteroids.maxSizes[row] - asteroids.sizes[row]) + 1) * self.thePlayer.scoreMultiplier
+            asteroids.shoot(row)
+            self.removeMe = True
+            break
     def think(self, others, context):
-        if time.clock() >= self.timeBorn + self.lifespan:
+        if self.thePlayer.clock.now() >= self.timeBorn + self.lifespan:
             self.removeMe = True
             return
         self.emitter.pos = self.pos
         newBearing = (self.bearing + 180) * math.pi / 180
         self.emitter.setDirection(newBearing, 1)
         self.emitter.think(None, context)
-        self.collisionCheck(others)
+        self.collisionCheck(others, context)
+    def bounds(self):
+        bounds = Entity.bounds(self)
+        if self.emitter.count:
+            bounds = unionBounds(bounds, self.emitter.box)
+        return bounds
+    def removed(self):
+        # its trail goes with it, and stops counting against the budget
+        self.emitter.clear()
     def render(self, dest):
         self.emitter.render(dest)
-        pygame.draw.circle(dest, (60,60,255), self.pos.getInt(), self.size)
+        drawCircle(dest, (60,60,255), self.pos.getInt(), self.size)
+
+Bullet.pool = makePool("Bullet", Bullet)
 
 class PlayerModifier(Entity):
     def __init__(self, thePlayer):
@@ -416,16 +1362,19 @@ class PlayerModifier(Entity):
         return None
     def render(self, dest):
         pass
+    def screenRect(self):
+        return None
     def think(self, others, context):
         pass
     def notify(self, event):
         pass
 
 class ImprovedEngineModifier(PlayerModifier):
+    efficiency = 1.1
     def __init__(self, thePlayer):
         PlayerModifier.__init__(self, thePlayer)
     def initialiseMod(self):
-        self.player.fuelCost /= 1.1
+        self.player.fuelCost /= self.efficiency
     def upgrade(self):
         return self
 
@@ -436,10 +1385,11 @@ class AutomaticGunModifier(PlayerModifier):
         self.player.automatic = True
 
 class RapidFireModifier(PlayerModifier):
+    delayCut = 100 # ms
     def __init__(self, thePlayer):
         PlayerModifier.__init__(self, thePlayer)
     def initialiseMod(self):
-        self.player.shotDelay -= 100
+        self.player.shotDelay -= self.delayCut
     def upgrade(self):
         return self
 
@@ -447,57 +1397,197 @@ class LaserSightModifier(PlayerModifier):
     def __init__(self, thePlayer):
         PlayerModifier.__init__(self, thePlayer)
         self.nextLevel = LaserSightModifierLevel2(thePlayer)
-    def render(self, dest):
+    def end(self):
         ex = self.player.pos.x + math.cos(self.player.bearing) * 1000.0
         ey = self.player.pos.y + math.sin(self.player.bearing) * 1000.0
-        pygame.draw.line(dest, (255,0,0), self.player.pos.get(), (ex, ey))
+        return ex, ey
+    def render(self, dest):
+        pygame.draw.line(dest, (255,0,0), self.player.pos.get(), self.end())
+    def screenRect(self):
+        ex, ey = self.end()
+        sx, sy = self.player.pos.get()
+        left, top = int(min(sx, ex)) - 1, int(min(sy, ey)) - 1
+        return pygame.Rect(left, top, int(max(sx, ex)) - left + 2, int(max(sy, ey)) - top + 2)
     def upgrade(self):
         return self.nextLevel
 
+class TrajectoryPredictor:
+    # where a bullet fired right now would go. it's moved the same way Bullet
+    # is, wrapping round the screen, for as long as it lives and up to the
+    # first asteroid it would hit. a wrap always puts the bullet on the far
+    # edge, so only the first wrap on each axis depends on where the ship is
+    # and the rest come round every so many ticks. that motion is cached on
+    # the shot quantised, the runs are laid out from the ship with a step per
+    # wrap rather than per tick. hits are worked out again once per tick
+    bearingSteps = 2048 # per turn
+    velocitySteps = 16 # per pixel per tick
+    def __init__(self, clock, cacheSize = 64):
+        self.clock = clock
+        self.cacheSize = cacheSize
+        self.motions = collections.OrderedDict()
+        self.hitKey = None
+        self.hit = None
+    def key(self, bearing, vel, speed):
+        turn = 2 * math.pi
+        return (int(round((bearing % turn) * self.bearingSteps / turn)) % self.bearingSteps,\
+                int(round(vel[0] * self.velocitySteps)), int(round(vel[1] * self.velocitySteps)), speed)
+    def motion(self, key):
+        # (velocity, ticks between wraps across and down), None for an axis
+        # it doesn't move along
+        motion = self.motions.get(key)
+        if motion is not None:
+            del self.motions[key]
+            self.motions[key] = motion
+            return motion
+        bearing, vx, vy, speed = key
+        bearing = bearing * 2 * math.pi / self.bearingSteps
+        vx = math.cos(bearing) * speed + vx / float(self.velocitySteps)
+        vy = math.sin(bearing) * speed + vy / float(self.velocitySteps)
+        width, height = getResolution()
+        motion = ((vx, vy), (self.crossing(0, abs(vx), width), self.crossing(0, abs(vy), height)))
+        self.motions[key] = motion
+        if len(self.motions) > self.cacheSize:
+            self.motions.popitem(False)
+        return motion
+    def crossing(self, start, v, extent):
+        # first tick start + v * tick goes past extent
+        if v == 0: return None
+        return int(math.floor((extent - start) / v)) + 1
+    def path(self, pos, key):
+        # (velocity, runs), each run is a straight stretch between wraps as
+        # (start x, start y, end x, end y, first tick, last tick)
+        (vx, vy), (periodX, periodY) = self.motion(key)
+        width, height = getResolution()
+        ticks = int(round(Bullet.lifespan / self.clock.dt))
+        x, y = pos
+        wrapX = self.crossing(x, vx, width) if vx >= 0 else self.crossing(-x, -vx, 0)
+        wrapY = self.crossing(y, vy, height) if vy >= 0 else self.crossing(-y, -vy, 0)
+        runs = []
+        startTick = 0
+        while True:
+            wrapTick = min([tick for tick in (wrapX, wrapY) if tick is not None] + [ticks + 1])
+            if wrapTick > ticks: break
+            steps = wrapTick - 1 - startTick
+            endX, endY = x + vx * steps, y + vy * steps
+            runs.append((x, y, endX, endY, startTick, wrapTick - 1))
+            x, y = endX + vx, endY + vy
+            if wrapTick == wrapX:
+                x = 0 if vx > 0 else width
+                wrapX += periodX
+            if wrapTick == wrapY:
+                y = 0 if vy > 0 else height
+                wrapY += periodY
+            startTick = wrapTick
+        steps = ticks - startTick
+        runs.append((x, y, x + vx * steps, y + vy * steps, startTick, ticks))
+        return (vx, vy), runs
+    def firstHit(self, path, radius, field):
+        # (run index, tick into the run) of the first asteroid hit, with the
+        # asteroids carrying on the way they're going, None for a clean miss
+        count = field.count
+        if count == 0: return None
+        (vx, vy), runs = path
+        alive = ~field.dead[:count]
+        ax = field.positions[:count, 0]
+        ay = field.positions[:count, 1]
+        wx = field.velocities[:count, 0]
+        wy = field.velocities[:count, 1]
+        reach = field.sizes[:count] + radius
+        for index, (x0, y0, x1, y1, first, last) in enumerate(runs):
+            # relative to each asteroid the bullet goes from d0 at the
+            # start of the run by motion per tick
+            d0x = x0 - (ax + wx * first)
+            d0y = y0 - (ay + wy * first)
+            motionX = vx - wx
+            motionY = vy - wy
+            a = motionX*motionX + motionY*motionY
+            b = d0x*motionX + d0y*motionY
+            c = d0x*d0x + d0y*d0y - reach*reach
+            disc = b*b - a*c
+            times = numpy.zeros(count)
+            touching = c <= 0
+            closing = ~touching & (b < 0) & (disc >= 0)
+            times[closing] = (-b[closing] - numpy.sqrt(disc[closing])) / a[closing]
+            hit = alive & (touching | (closing & (times <= last - first)))
+            if hit.any():
+                return index, float(times[hit].min())
+        return None
+    def predict(self, pos, bearing, vel, speed, radius, field):
+        # returns the list of straight lines to draw and where the bullet
+        # would hit, or None
+        key = self.key(bearing, vel, speed)
+        path = self.path(pos, key)
+        (vx, vy), runs = path
+        hitKey = (int(pos[0]), int(pos[1]), key, radius, self.clock.ticks // getParticleBudget().sightInterval())
+        if hitKey != self.hitKey:
+            self.hitKey = hitKey
+            self.hit = None
+            if field is not None:
+                self.hit = self.firstHit(path, radius, field)
+        lines = []
+        for index, (x0, y0, x1, y1, first, last) in enumerate(runs):
+            if self.hit is not None and index == self.hit[0]:
+                t = self.hit[1]
+                end = (x0 + vx * t, y0 + vy * t)
+                lines.append(((x0, y0), end))
+                return lines, end
+            lines.append(((x0, y0), (x1, y1)))
+        return lines, None
+
 class LaserSightModifierLevel2(PlayerModifier):
     def __init__(self, thePlayer):
         PlayerModifier.__init__(self, thePlayer)
+        self.predictor = TrajectoryPredictor(thePlayer.clock)
+        self.field = None
+        self.drawn = None
+    def think(self, others, context):
+        self.field = context.asteroids
     def render(self, dest):
-        mx, my = self.player.vel.get()
-        bx = mx + math.cos(self.player.bearing) * self.player.bulletSpeed
-        by = my + math.sin(self.player.bearing) * self.player.bulletSpeed
-        dx, dy = self.player.pos.get()
-        for x in range(100):
-            pygame.draw.circle(dest, (255,0,0), (dx,dy), 2)
-            scaleFactor = 2
-            dx += (bx * scaleFactor)
-            dy += (by * scaleFactor)
+        player = self.player
+        lines, hit = self.predictor.predict(player.pos.get(), player.bearing, player.vel.get(),\
+                                            player.bulletSpeed, player.bulletSize, self.field)
+        self.drawn = None
+        for start, end in lines:
+            rect = pygame.draw.line(dest, (255,0,0), start, end, 2)
+            if self.drawn is None: self.drawn = rect
+            else: self.drawn.union_ip(rect)
+        if hit is not None:
+            drawCircle(dest, (255,0,0), hit, 4)
+            x, y = int(hit[0]), int(hit[1])
+            self.drawn.union_ip(pygame.Rect(x - 5, y - 5, 11, 11))
+    def screenRect(self):
+        if self.drawn is None: return None
+        return self.drawn.inflate(2, 2)
 
 class LargerBulletModifier(PlayerModifier):
+    growth = 1
     def __init__(self, thePlayer):
         PlayerModifier.__init__(self, thePlayer)
     def initialiseMod(self):
-        self.player.bulletSize += 1
+        self.player.bulletSize += self.growth
     def upgrade(self):
         return self
 
 class AutoEvasionModifier(PlayerModifier):
+    panicDistance = 200.0
+    force = 50.0
     def __init__(self, thePlayer):
         PlayerModifier.__init__(self, thePlayer)
-        self.panicDistance = 200.0
-        self.force = 50.0
     def think(self, others, context):
-        for x in range(len(others)):
-            entity = others[x]
-            if entity is self: continue
-            if not isinstance(entity, Asteroid): continue
-            mx, my = self.player.pos.get()
-            ox, oy = entity.pos.get()
-            dx, dy = mx-ox, my-oy
-            distance = math.sqrt((dx*dx)+(dy*dy))
-            if distance < self.panicDistance:
-                angle = math.atan2(dy, dx)
-                finalMultiplier = (1 / distance ** 2) * self.force
-                self.player.vel.x += math.cos(angle) * finalMultiplier
-                self.player.vel.y += math.sin(angle) * finalMultiplier
-                self.player.score -= finalMultiplier
+        # pushed directly away from everything nearby, by force over distance squared
+        asteroids = context.asteroids
+        rows, distances = asteroids.queryRadius(self.player.pos, self.panicDistance)
+        near = distances > 0
+        rows, distances = rows[near], distances[near]
+        if len(rows) == 0: return
+        mx, my = self.player.pos.get()
+        multipliers = self.force / (distances * distances)
+        self.player.vel.x += float(numpy.sum((mx - asteroids.positions[rows, 0]) / distances * multipliers))
+        self.player.vel.y += float(numpy.sum((my - asteroids.positions[rows, 1]) / distances * multipliers))
+        self.player.score -= float(numpy.sum(multipliers))
 
 class Control(Entity):
+    system = "overlays"
     def __init__(self, pos, size):
         Entity.__init__(self, pos)
         self.pos = pos
@@ -560,13 +1650,13 @@ class Panel(GroupControl):
         GroupControl.render(self, dest)
 
 class ToastPopup(Control):
-    def __init__(self, pos, text, bgCol, fontCol, fontSize = 12):
+    def __init__(self, pos, text, bgCol, fontCol, clock, fontSize = 12):
         Control.__init__(self, pos, Vec2D(0,0))
+        self.clock = clock
         self.parent = None
         self.text = text
         self.bgCol = bgCol
-        tempFont = makeFont(fontSize)
-        self.renderText = tempFont.render(self.text, True, fontCol)
+        self.renderText = renderText(self.text, fontSize, fontCol)
         width, height = self.renderText.get_size()
         self.size = Vec2D(width + 20, height + 20)
         self.renderBounds = ((0,0),self.size.get())
@@ -575,14 +1665,14 @@ class ToastPopup(Control):
         self.snapDist = 0.5
         self.lifeSpanWhenStopped = None
         self.lifeSpan = None
-        self.timeBorn = time.clock()
-    def __del__(self):
+        self.timeBorn = self.clock.now()
+    def removed(self):
         if self.parent is not None:
             self.parent.toastCount -= 1
     def setLife(self, life, reset = True):
         self.lifeSpan = life
         if reset:
-            self.timeBorn = time.clock()
+            self.timeBorn = self.clock.now()
     def setTranslation(self, dest, newSpeed, newLifeSpanWhenStopped = None):
         self.lifeSpanWhenStopped = newLifeSpanWhenStopped
         if dest is not None:
@@ -594,7 +1684,7 @@ class ToastPopup(Control):
         else: self.speed = None
     def think(self, others, context):
         if self.lifeSpan is not None:
-            if time.clock() >= self.timeBorn + (self.lifeSpan / 1000.0):
+            if self.clock.now() >= self.timeBorn + (self.lifeSpan / 1000.0):
                 self.removeMe = True
         if self.destPos is not None and self.speed is not None:
             cx, cy = self.pos.get()
@@ -603,18 +1693,18 @@ class ToastPopup(Control):
             distance = math.sqrt((dx**2)+(dy**2))
             if distance == 0: return
             if distance < self.snapDist:
-                self.pos = Vec2D(tx, ty)
+                self.pos.set(tx, ty)
                 return
             angle = math.atan2(dy, dx)
             angle += math.pi
             mx = math.cos(angle) * self.speed
             my = math.sin(angle) * self.speed
-            self.pos = Vec2D(cx + mx, cy + my)
+            self.pos.set(cx + mx, cy + my)
             cx, cy = self.pos.get()
             dx, dy = cx-tx, cy-ty
             distance = math.sqrt((dx**2)+(dy**2))
             if distance < self.snapDist:
-                self.pos = Vec2D(tx, ty)
+                self.pos.set(tx, ty)
                 self.setLife(self.lifeSpanWhenStopped)
     def render(self, dest):
         pygame.draw.rect(dest, self.bgCol, (self.pos.get(), self.size.get()))
@@ -622,8 +1712,9 @@ class ToastPopup(Control):
         dest.blit(self.renderText, (x+10,y+10,0,0))
 
 class ToastManager(Control):
-    def __init__(self, toastCount, bgCol, txtCol, lifeSpan, startPos, direction, speed):
+    def __init__(self, toastCount, bgCol, txtCol, lifeSpan, startPos, direction, speed, clock):
         Control.__init__(self, startPos, Vec2D(0,0))
+        self.clock = clock
         self.maxToast = toastCount
         self.toastCount = 0
         self.bgCol = bgCol
@@ -635,10 +1726,15 @@ class ToastManager(Control):
         self.speed = speed
         self.renderBounds = None
         self.newToasts = []
+    def clear(self):
+        # toasts left in a world that's been thrown away never leave its
+        # registry, so they're forgotten about here instead
+        self.toastCount = 0
+        self.newToasts = []
     def popup(self, text):
         if self.toastCount >= self.maxToast: return False
         newX, newY = self.pos.get()
-        newToast = ToastPopup(Vec2D(newX, newY), text, self.bgCol, self.txtCol, self.fontSize)
+        newToast = ToastPopup(Vec2D(newX, newY), text, self.bgCol, self.txtCol, self.clock, self.fontSize)
         destX, destY = newX, newY
         renderW, renderH = newToast.size.get()
         destX += (self.toastCount + 1) * self.dir[0] * renderW
@@ -650,7 +1746,7 @@ class ToastManager(Control):
         return True
     def think(self, others, context):
         for toast in self.newToasts:
-            others.append(toast)
+            others.spawn(toast)
         self.newToasts = []
     up = (0,-1)
     right = (1,0)
@@ -665,7 +1761,7 @@ class Button(Control):
         self.enabled = True
         self.dpCol = depressedColour
         self.text = text
-        self.font = makeFont(10)
+        self.fontSize = 10
         self.txtCol = textColour
         self.hook = callBack
         self.arg = argument
@@ -676,11 +1772,11 @@ class Button(Control):
         pygame.draw.rect(dest, colour, (self.pos.get(), self.size.get()))
         textColour = self.txtCol
         if not self.enabled: textColour = (100,100,100)
-        renderedText = self.font.render(self.text, True, self.txtCol)
+        renderedText = renderText(self.text, self.fontSize, self.txtCol)
         x, y = self.pos.get()
         rw, rh = renderedText.get_size()
-        dx = x + (self.size.x - rw) / 2
-        dy = y + (self.size.y - rh) / 2
+        dx = x + (self.size.x - rw) // 2
+        dy = y + (self.size.y - rh) // 2
         dest.blit(renderedText, ((dx,dy,0,0)))
     def notify(self, event):
         if not self.enabled: return
@@ -705,49 +1801,96 @@ class Button(Control):
                 if self.hook is not None:
                     self.hook(self.arg)
 
-class PopupMessageBase(Control):
+class Scene:
+    # a modal screen on the SceneStack, the world stands still while one's open
+    opaque = False # covers the whole screen, so nothing under it is drawn
+    recorded = True # what it's sent goes into the replay log
+    def open(self, context, onClose = None):
+        # onClose is called with the scene's return value once it's closed
+        self.closed = False
+        self.returnValue = None
+        self.onClose = onClose
+        context.scenes.push(self)
+    def close(self, returnValue = None):
+        self.closed = True
+        self.returnValue = returnValue
+    def notify(self, event):
+        pass
+    def render(self, dest):
+        pass
+
+class SceneStack:
+    # modal screens over the game. while any are open the world isn't
+    # stepped, the main loop hands its events to the top scene and only
+    # redraws when one of them might have changed
+    def __init__(self):
+        self.scenes = []
+        self.dirty = False
+    def active(self):
+        return len(self.scenes) > 0
+    def covered(self):
+        for scene in self.scenes:
+            if scene.opaque: return True
+        return False
+    def push(self, scene):
+        self.scenes.append(scene)
+        self.dirty = True
+    def handle(self, events, context):
+        # anything left over once the last scene closes is dropped, the same
+        # way whether it's a player or a replay sending it
+        recorded = []
+        for event in events:
+            if not self.scenes: break
+            scene = self.scenes[-1]
+            if scene.recorded:
+                recorded.append(event)
+            scene.notify(event)
+            if event.type != pygame.MOUSEMOTION:
+                self.dirty = True
+            while self.scenes and self.scenes[-1].closed:
+                scene = self.scenes.pop()
+                context.redrawAll = True
+                if scene.onClose is not None:
+                    scene.onClose(scene.returnValue)
+        if recorded and context.recorder is not None:
+            context.recorder.poll(context.clock.ticks, recorded)
+    def render(self, dest):
+        first = 0
+        for index, scene in enumerate(self.scenes):
+            if scene.opaque: first = index
+        for scene in self.scenes[first:]:
+            scene.render(dest)
+        self.dirty = False
+
+class PopupMessageBase(Control, Scene):
     def __init__(self, message, col, txtCol, fontSize = 10):
         Control.__init__(self, Vec2D(0,0), Vec2D(0,0))
         self.msg = message
         self.col = col
-        self.active = False
         self.txtCol = txtCol
-        font = makeFont(fontSize)
-        self.msgRender = font.render(self.msg, True, self.txtCol)
+        self.msgRender = renderText(self.msg, fontSize, self.txtCol)
         width, height = getResolution()
         renderW, renderH = self.msgRender.get_size()
-        self.pos = Vec2D((width-renderW)/2 - 10,(height-renderH)/2 - 10)
+        self.pos = Vec2D((width-renderW)//2 - 10,(height-renderH)//2 - 10)
         self.size = Vec2D(renderW + 20, renderH + 20)
         self.buttons = []
         self.returnValue = None
-    def activate(self, others, context):
-        self.active = True
-        self.returnValue = None
-        self.think(others, context)
-        return self.returnValue
+    def activate(self, context, onClose = None):
+        if not context.canPrompt():
+            # nobody to answer the popup without a display or a replay
+            if onClose is not None:
+                onClose(None)
+            return
+        self.open(context, onClose)
     def notify(self, event):
         for button in self.buttons:
             button.notify(event)
-    def think(self, others, context):
-        fpsLimit = pygame.time.Clock()
-        background = pygame.Surface(context.screen.get_size())
-        background.blit(context.screen, (0,0,0,0))
-        while self.active:
-            fpsLimit.tick(30)
-            for event in pygame.event.get():
-                self.notify(event)
-            for button in self.buttons:
-                button.think(others, context)
-            context.screen.blit(background, (0,0,0,0))
-            self.render(context.screen)
-            pygame.display.flip()
     def render(self, dest):
-        if self.active:
-            pygame.draw.rect(dest, self.col, (self.pos.get(), self.size.get()))
-            x, y = self.pos.get()
-            dest.blit(self.msgRender, ((x+10,y+10), (0,0)))
-            for button in self.buttons:
-                button.render(dest)
+        pygame.draw.rect(dest, self.col, (self.pos.get(), self.size.get()))
+        x, y = self.pos.get()
+        dest.blit(self.msgRender, ((x+10,y+10), (0,0)))
+        for button in self.buttons:
+            button.render(dest)
 
 class PopupMessageOK(PopupMessageBase):
     def __init__(self, message, col, txtCol, fontSize = 10):
@@ -757,12 +1900,11 @@ class PopupMessageOK(PopupMessageBase):
         by += 10
         r,g,b = self.col
         renderW, renderH = self.msgRender.get_size()
-        self.okButton = Button(Vec2D(bx+renderW/2-30, by+renderH), Vec2D(60,20), self.col, (r-10,g-10,b-10), "OK", self.txtCol, self.okPressed, self)
+        self.okButton = Button(Vec2D(bx+renderW//2-30, by+renderH), Vec2D(60,20), self.col, (r-10,g-10,b-10), "OK", self.txtCol, self.okPressed, self)
         self.buttons.append(self.okButton)
         self.size.y += 20
     def okPressed(button, self):
-        self.active = False
-        self.returnValue = True
+        self.close(True)
     def notify(self, event):
         PopupMessageBase.notify(self, event)
         if event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
@@ -776,18 +1918,49 @@ class PopupMessageYesNo(PopupMessageBase):
         by += 10
         r,g,b = self.col
         renderW, renderH = self.msgRender.get_size()
-        self.yesButton = Button(Vec2D(bx+renderW/2-65, by+20), Vec2D(60,20), self.col, (r-10,g-10,b-10), "YES", self.txtCol, self.yesPressed, self)
-        self.noButton = Button(Vec2D(bx+renderW/2+5, by+20), Vec2D(60,20), self.col, (r-10,g-10,b-10), "NO", self.txtCol, self.noPressed, self)
+        self.yesButton = Button(Vec2D(bx+renderW//2-65, by+20), Vec2D(60,20), self.col, (r-10,g-10,b-10), "YES", self.txtCol, self.yesPressed, self)
+        self.noButton = Button(Vec2D(bx+renderW//2+5, by+20), Vec2D(60,20), self.col, (r-10,g-10,b-10), "NO", self.txtCol, self.noPressed, self)
         self.size.y += 20
         self.buttons = [self.yesButton, self.noButton]
     def yesPressed(button, self):
-        self.active = False
-        self.returnValue = True
+        self.close(True)
     def noPressed(button, self):
-        self.active = False
-        self.returnValue = False
+        self.close(False)
+
+class GameOverScene(Scene):
+    # keys are ignored for a moment so whatever the player was pressing when
+    # they died doesn't skip straight past it
+    opaque = True
+    recorded = False # replays go straight on to the next game
+    def __init__(self, ignoreDelay = 1000):
+        self.ignoreUntil = timer() + ignoreDelay / 1000.0
+        self.gameOver = renderText("Game Over!", 40, (255,255,255))
+        self.pressAnyKey = renderText("Press any key to try again!", 40, (255,255,255))
+    def notify(self, event):
+        if event.type == pygame.KEYDOWN and timer() >= self.ignoreUntil:
+            self.close()
+    def render(self, dest):
+        width, height = getResolution()
+        dest.fill((0,0,0))
+        dest.blit(self.gameOver, ((width - self.gameOver.get_size()[0])//2, height // 2, 0,0))
+        dest.blit(self.pressAnyKey, ((width - self.pressAnyKey.get_size()[0])//2, height // 2 + 36, 0,0))
+
+class ShopScene(Scene):
+    opaque = True
+    def __init__(self, shop):
+        self.shop = shop
+    def notify(self, event):
+        if event.type == pygame.KEYDOWN and (event.key == pygame.K_b or event.key == pygame.K_ESCAPE):
+            self.close()
+        else:
+            self.shop.gui.notify(event)
+    def render(self, dest):
+        dest.fill((0,0,0))
+        self.shop.gui.render(dest)
 
 class UpgradeShop(Entity):
+    system = "overlays"
+    subscriptions = [(pygame.KEYDOWN, pygame.K_b)]
     def __init__(self, thePlayer):
         Entity.__init__(self, Vec2D(0,0))
         self.player = thePlayer
@@ -801,6 +1974,8 @@ class UpgradeShop(Entity):
         self.buyable = []
         self.gui.add(self.shopPanel)
         self.gui.setActive(False)
+        self.scene = None
+        self.autoConfirm = False # bots buy without being asked
         self.addBuyable(  500, "Efficient Engine", ImprovedEngineModifier(thePlayer), 4)
         self.addBuyable( 2000, "Laser Sight", LaserSightModifier(thePlayer), 2)
         self.addBuyable( 6000, "Automatic Gun", AutomaticGunModifier(thePlayer))
@@ -813,93 +1988,93 @@ class UpgradeShop(Entity):
         button = Button(Vec2D(5, 10 + len(self.buyable) * 30),Vec2D(100,20),(50,50,255),(0,0,255),name,(255,255,0),self.buyItemButton, (self, len(self.buyable), None))
         self.buyable.append((price, name, mod, button, 0, maxLevel))
         self.itemPanel.add(button)
-    def buyItemButton(button, (self, index, context)):
+    def buyItemButton(button, args):
+        self, index, context = args
         price, name, mod, button, level, maxLevel = self.buyable[index]
+        if level == 0:
+            question = "Purchase %s (%s points)?" % (name, price)
+        else:
+            question = "Upgrade %s (%s points)?" % (name, price)
+        def answered(result):
+            if result: self.buy(index, context)
+        self.ask(question, context, answered)
+    def buy(self, index, context):
+        price, name, mod, button, level, maxLevel = self.buyable[index]
+        if self.player.score < price + 100:
+            self.alert("You cannot afford this item!", context)
+            return
         level = level + 1
         if level == 1:
-            if not self.purchaseSomething(price, name, mod, context): return
+            self.purchaseSomething(price, mod)
             context.toastManager.popup("You bought '%s' for %s points!" % (name, price))
-            if level < maxLevel:
-                name = name[:-2] + " " + str(level + 1)
-            button.text = name
-            self.buyable[index] = (price, name, mod, button, level, maxLevel)
         else:
-            if not self.upgradeSomething(price, name, mod, button, level, maxLevel, context): return
+            mod = self.upgradeSomething(price, mod)
             context.toastManager.popup("You upgraded '%s' for %s points!" % (name, price))
-            if level < maxLevel:
-                name = name[:-2] + " " + str(level + 1)
-            button.text = name
-            self.buyable[index] = (price * 1.5, name, mod, button, level, maxLevel)
+            price = price * 1.5
+        if level < maxLevel:
+            name = name[:-2] + " " + str(level + 1)
+        button.text = name
+        self.buyable[index] = (price, name, mod, button, level, maxLevel)
         if level == maxLevel:
             button.enabled = False
-    def upgradeSomething(self, price, name, mod, button, level, maxLevel, context):
-        confirmPurchase = PopupMessageYesNo("Upgrade %s (%s points)?" % (name, price), (50,50,255), (255,255,0))
-        result = confirmPurchase.activate(None, context)
-        if not result: return False
-        if self.player.score < price + 100:
-            alert = PopupMessageOK("You cannot afford this item!", (255,50,50), (255,255,0))
-            alert.activate(None, context)
-            return False
+    def ask(self, question, context, answered):
+        if self.autoConfirm:
+            answered(True)
+            return
+        confirmPurchase = PopupMessageYesNo(question, (50,50,255), (255,255,0))
+        confirmPurchase.activate(context, answered)
+    def alert(self, message, context):
+        if self.autoConfirm: return
+        alert = PopupMessageOK(message, (255,50,50), (255,255,0))
+        alert.activate(context)
+    def upgradeSomething(self, price, mod):
         self.player.modifiers.remove(mod)
         mod = mod.upgrade()
         self.player.addModifier(mod)
         self.player.score -= price
-        return True
-    def purchaseSomething(self, price, name, mod, context):
-        confirmPurchase = PopupMessageYesNo("Purchase %s (%s points)?" % (name, price), (50,50,255), (255,255,0))
-        result = confirmPurchase.activate(None, context)
-        if not result: return False
-        if self.player.score < price + 100:
-            alert = PopupMessageOK("You cannot afford this item!", (255,50,50), (255,255,0))
-            alert.activate(None, context)
-            return False
+        return mod
+    def purchaseSomething(self, price, mod):
         self.player.addModifier(mod)
         self.player.score -= price
-        return True
     def closeShopHandle(button, self):
+        if self.scene is not None:
+            self.scene.close()
+    def leaveShop(self, returnValue):
+        self.scene = None
         self.gui.setActive(False)
-    def render(self, dest):
-        self.gui.render(dest)
+        self.player.paused = True
     def think(self, others, context):
+        if not self.gui.active or self.scene is not None: return
+        if not context.canPrompt():
+            self.gui.setActive(False)
+            return
         for price, name, mod, button, level, maxLevel in self.buyable:
             button.arg = (button.arg[0], button.arg[1], context)
-        if self.gui.active:
-            exitShop = False
-            limitFps = pygame.time.Clock()
-            while not exitShop and self.gui.active:
-                limitFps.tick(30)
-                for event in pygame.event.get():
-                    if event.type == pygame.KEYDOWN and (event.key == pygame.K_b or event.key == pygame.K_ESCAPE):
-                        self.gui.setActive(False)
-                        exitShop = True
-                    else:
-                        self.gui.notify(event)
-                context.screen.fill((0,0,0))
-                self.gui.think(others, context)
-                self.gui.render(context.screen)
-                pygame.display.flip()
-            self.player.paused = True
+        self.scene = ShopScene(self)
+        self.scene.open(context, self.leaveShop)
     def notify(self, event):
         if event.type == pygame.KEYDOWN and event.key == pygame.K_b:
             if not self.gui.active:
                 self.gui.setActive(True)
 
 class Player(Entity):
-    def __init__(self, pos):
+    # modifiers are handed whatever the player hears about
+    subscriptions = list((pygame.KEYDOWN, key) for key in [pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d, pygame.K_SPACE, pygame.K_p])\
+                  + list((pygame.KEYUP, key) for key in [pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d, pygame.K_SPACE])
+    system = "controllers"
+    def __init__(self, pos, clock):
         Entity.__init__(self, pos)
-        self.gameConfig = INIFile("settings.ini")
-        self.gameConfig.readonly = False # it will error if the file didn't exist, but we'll generate it if it broke
-        if not self.gameConfig.hasSection("misc"):
-            self.gameConfig.sections["misc"] = {}
+        self.clock = clock
+        self.gameConfig = getSettings()
         if not self.gameConfig.hasValue("misc","highestScore"):
-            self.gameConfig.sections["misc"]["highestScore"] = 0.0
+            self.gameConfig.makeValue("misc", "highestScore", 0.0)
         if not self.gameConfig.hasValue("misc", "doneTutorial"):
-            self.gameConfig.sections["misc"]["doneTutorial"] = "False"
+            self.gameConfig.makeValue("misc", "doneTutorial", "False")
         self.modifiers = []
         self.renderBounds = ((-20,-20),(20,20))
-        self.lastShot = time.clock()
+        self.lastShot = self.clock.now()
         self.shotDelay = 200 # ms
-        self.lastNotified = time.clock()
+        self.lastNotified = self.clock.now()
         self.notifyDelay = 5000.0
         self.bearing = 0.0
         self.automatic = False
@@ -916,78 +2091,93 @@ class Player(Entity):
         self.highestScore = self.score
         if self.highestScore > self.bestScoreEver:
             self.bestScoreEver = self.highestScore
-            self.gameConfig.sections["misc"]["highestScore"] = self.bestScoreEver
+            self.gameConfig.makeValue("misc", "highestScore", self.bestScoreEver)
         self.fuelCost = 1.0
         self.accelNow = [0.0,0.0]
         self.accel = 0.1
         self.fire = False
         self.paused = False
+        self.gameOver = None
         self.rotVel = 0.05
         self.emitter = ParticleEmitter(self.pos, 400, [1,50], [2,6],\
                                        [200,2000], [[255,100,0],[255,255,0],\
-                                                    [50,50,50],[100,100,100]])
+                                                    [50,50,50],[100,100,100]], self.clock)
         self.pewpewEmitter = ParticleEmitter(self.pos, 300, None, [1,2],\
-                                             [200,1000], [(0,0,255), (50,50,255), (100,100,255)])
+                                             [200,1000], [(0,0,255), (50,50,255), (100,100,255)], self.clock)
     def popup(self, context, text, override = False):
-        if (time.clock() >= self.lastNotified + (self.notifyDelay / 1000.0)) or override:
+        if (self.clock.now() >= self.lastNotified + (self.notifyDelay / 1000.0)) or override:
             context.toastManager.popup(text)
-            self.lastNotified = time.clock()
+            self.lastNotified = self.clock.now()
     def addModifier(self, mod):
         self.modifiers.append(mod)
         mod.initialiseMod()
     def accelerate(self, amplitude):
-        mx, my = self.vel.get()
-        mx += math.cos(self.bearing) * amplitude
-        my += math.sin(self.bearing) * amplitude
-        self.vel = Vec2D(mx, my)
+        self.vel.x += math.cos(self.bearing) * amplitude
+        self.vel.y += math.sin(self.bearing) * amplitude
     def render(self, dest):
+        profiler = getProfiler()
         for mod in self.modifiers:
-            mod.render(dest)
+            if profiler is None:
+                mod.render(dest)
+            else:
+                start = timer()
+                mod.render(dest)
+                profiler.addEntity("render", mod.__class__.__name__, timer() - start)
         secondPoint = [self.pos.getX(), self.pos.getY()]
         secondPoint[0] += math.cos(self.bearing) * 20
         secondPoint[1] += math.sin(self.bearing) * 20
         self.emitter.render(dest)
         self.pewpewEmitter.render(dest)
         pygame.draw.line(dest, (255,255,255), self.pos.getInt(), secondPoint)
-        pygame.draw.circle(dest, (255,0,0), self.pos.getInt(), int(self.size))
-    def tutorial(self, text, size, context):
-        PopupMessageOK(text, (50,50,255),(255,255,0), size).activate(None, context)
+        drawCircle(dest, (255,0,0), self.pos.getInt(), int(self.size))
+    def bounds(self):
+        bounds = Entity.bounds(self)
+        for emitter in [self.emitter, self.pewpewEmitter]:
+            if emitter.count:
+                bounds = unionBounds(bounds, emitter.box)
+        return bounds
+    def screenRect(self):
+        rect = Entity.screenRect(self)
+        for mod in self.modifiers:
+            modRect = mod.screenRect()
+            if modRect is not None:
+                rect.union_ip(modRect)
+        return rect
+    def tutorial(self, tips, context):
+        # one after the other, the last one pushed is the first one shown
+        for text, size in reversed(tips):
+            PopupMessageOK(text, (50,50,255),(255,255,0), size).activate(context)
+    def tryAgain(self, context):
+        def closed(returnValue):
+            context.reset = True
+        return closed
     def think(self, others, context):
         if self.gameConfig.getValue("misc", "doneTutorial") != "True":
             self.gameConfig.makeValue("misc", "doneTutorial", "True")
-            self.tutorial("Since this is (presumably) your first time playing the game, here are some tips!", 20, context)
-            self.tutorial("Use W, A, S and D to fly, SPACE to pew pew and B to open the shop!", 20, context)
-            self.tutorial("Hit asteroids for points, hit several in a row for multipliers!", 20, context)
-            self.tutorial("That's it! Now shoot stuff!", 40, context)
-            self.tutorial("Oh yeah, it goes without saying but, don't touch the asteroids :/", 20, context)
-            self.gameConfig.save()
+            self.tutorial([("Since this is (presumably) your first time playing the game, here are some tips!", 20),
+                           ("Use W, A, S and D to fly, SPACE to pew pew and B to open the shop!", 20),
+                           ("Hit asteroids for points, hit several in a row for multipliers!", 20),
+                           ("That's it! Now shoot stuff!", 40),
+                           ("Oh yeah, it goes without saying but, don't touch the asteroids :/", 20)], context)
         if self.paused:
             pauseGame = PopupMessageOK("The game is paused, press OK to continue!", (50,50,255),(255,255,0))
-            pauseGame.activate(None, context)
+            pauseGame.activate(context)
             self.paused = False
         if self.lostGame:
-            context.reset = True
-            keyPressed = False
-            font = makeFont(40)
-            gameOver = font.render("Game Over!", True, (255,255,255))
-            pressAnyKey = font.render("Press any key to try again!", True, (255,255,255))
-            ignoreDelay = 1000
-            width, height = getResolution()
-            ignoreStart = time.clock()
-            limitFps = pygame.time.Clock()
-            while not keyPressed:
-                limitFps.tick(30)
-                for event in pygame.event.get():
-                    if time.clock() >= ignoreStart + (ignoreDelay / 1000.0):
-                        if event.type == pygame.KEYDOWN:
-                            keyPressed = True
-                context.screen.fill((0,0,0))
-                context.screen.blit(gameOver, ((width - gameOver.get_size()[0])/2, height / 2, 0,0))
-                context.screen.blit(pressAnyKey, ((width - pressAnyKey.get_size()[0])/2, height / 2 + 36, 0,0))
-                pygame.display.flip()
+            if context.headless or context.replay is not None:
+                context.reset = True
+            elif self.gameOver is None:
+                self.gameOver = GameOverScene()
+                self.gameOver.open(context, self.tryAgain(context))
             return
+        profiler = getProfiler()
         for mod in self.modifiers:
-            mod.think(others, context)
+            if profiler is None:
+                mod.think(others, context)
+            else:
+                start = timer()
+                mod.think(others, context)
+                profiler.addEntity("think", mod.__class__.__name__, timer() - start)
         if self.score > self.highestScore:
             popupText = "Woot! New high score for this round!"
             self.highestScore = self.score
@@ -997,27 +2187,25 @@ class Player(Entity):
                 self.score += bonusSize
                 self.highestScore += 100
                 self.bestScoreEver = self.highestScore
-                self.gameConfig.sections["misc"]["highestScore"] = self.bestScoreEver
-                self.gameConfig.save()
+                self.gameConfig.makeValue("misc", "highestScore", self.bestScoreEver)
             self.popup(context, popupText)
-        if self.fire and time.clock() >= self.lastShot + (self.shotDelay / 1000.0):
-            self.lastShot = time.clock()
+        if self.fire and self.clock.now() >= self.lastShot + (self.shotDelay / 1000.0):
+            self.lastShot = self.clock.now()
             self.score -= 1
             if not self.automatic:
                 self.fire = False
             x, y = self.pos.get()
-            newBullet = Bullet(Vec2D(x,y), self.bulletSize, self.bearing, self.bulletSpeed, self)
+            newBullet = Bullet.pool.acquire(x, y, self.bulletSize, self.bearing, self.bulletSpeed, self)
             newBullet.setClipValues((0,0), getResolution(), True)
             newBullet.vel.x += self.vel.x
             newBullet.vel.y += self.vel.y
-            others.append(newBullet)
-            partCount = random.randint(2,4)
+            others.spawn(newBullet)
+            partCount = randint(2,4)
             self.accelerate(-self.accel*2.0)
+            self.pewpewEmitter.pos = self.pos
             for x in range(partCount):
-                myX, myY = self.pos.get()
-                self.pewpewEmitter.pos = Vec2D(myX, myY)
-                theAngle = random.randint(1,360)*math.pi/180
-                thePower = random.randint(10,30)/10.0
+                theAngle = randint(1,360)*math.pi/180
+                thePower = randint(10,30)/10.0
                 self.pewpewEmitter.setDirection(theAngle, thePower)
                 self.pewpewEmitter.emit()
         self.accelerate(self.accelNow[0])
@@ -1027,15 +2215,8 @@ class Player(Entity):
         self.emitter.pos = self.pos
         self.emitter.think(None, context)
         self.pewpewEmitter.think(None, context)
-        for entity in others:
-            if entity is self: continue
-            if not isinstance(entity, Asteroid): continue
-            mx, my = self.pos.get()
-            ax, ay = entity.pos.get()
-            dx, dy = mx-ax, my-ay
-            distance = math.sqrt((dx*dx)+(dy*dy))
-            if distance <= self.size + entity.size:
-                self.lostGame = True
+        if len(context.asteroids.querySwept(self.sweepStart(), self.pos.get(), self.size)):
+            self.lostGame = True
         if self.score <= 0.0:
             self.lostGame = True
     def notify(self, event):
@@ -1065,9 +2246,488 @@ class Player(Entity):
                 self.fire = False
 
 class GameContext:
-    def __init__(self):
+    def __init__(self, screen = None, clock = None):
         self.run = True
         self.reset = False
+        if clock is None:
+            clock = SimulationClock()
+        self.clock = clock
+        self.asteroids = None
+        self.redrawAll = True
+        self.screen = screen
+        self.headless = (screen is None)
+        self.toastManager = None
+        self.recorder = None
+        self.replay = None
+        self.scenes = SceneStack()
+    def canPrompt(self):
+        # popups need someone to answer them, a player or a replay of one
+        if self.replay is not None:
+            return self.replay.prompts
+        return self.screen is not None
+
+# replay log: a header then a list of records, each starting with a kind byte.
+# world records hold the seed, the saved settings the player starts with and
+# whether popups could be answered, tick records hold what World.step was given
+# and poll records what a popup or the shop read while the simulation waited
+REPLAY_MAGIC = b"ASRP"
+REPLAY_VERSION = 4
+REPLAY_WORLD = 1
+REPLAY_TICK = 2
+REPLAY_POLL = 3
+REPLAY_END = 4
+replayHeader = struct.Struct("<4sB")
+replayRecord = struct.Struct("<BIH")
+replayWorld = struct.Struct("<IdBB")
+replayEvent = struct.Struct("<HBiHBhh")
+EVENT_KEY = 1
+EVENT_POS = 2
+EVENT_BUTTON = 4
+
+class ReplayError(Exception):
+    pass
+
+def packEvent(event):
+    flags = 0
+    key = mod = button = x = y = 0
+    attributes = event.dict
+    if "key" in attributes:
+        flags |= EVENT_KEY
+        key = attributes["key"]
+        mod = attributes.get("mod", 0)
+    if "pos" in attributes:
+        flags |= EVENT_POS
+        x, y = attributes["pos"]
+    if "button" in attributes:
+        flags |= EVENT_BUTTON
+        button = attributes["button"]
+    return replayEvent.pack(event.type, flags, key, mod & 0xffff, button, x, y)
+
+def unpackEvent(data, offset):
+    eventType, flags, key, mod, button, x, y = replayEvent.unpack_from(data, offset)
+    attributes = {}
+    if flags & EVENT_KEY:
+        attributes["key"] = key
+        attributes["mod"] = mod
+    if flags & EVENT_POS:
+        attributes["pos"] = (x, y)
+    if flags & EVENT_BUTTON:
+        attributes["button"] = button
+    return pygame.event.Event(eventType, attributes)
+
+class ReplayWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "wb")
+        self.file.write(replayHeader.pack(REPLAY_MAGIC, REPLAY_VERSION))
+    def beginWorld(self, tick, seed, bestScore, doneTutorial, prompts):
+        self.file.write(replayRecord.pack(REPLAY_WORLD, tick, 0))
+        self.file.write(replayWorld.pack(seed, bestScore, doneTutorial, prompts))
+    def writeEvents(self, kind, tick, events):
+        self.file.write(replayRecord.pack(kind, tick, len(events)))
+        for event in events:
+            self.file.write(packEvent(event))
+    def tick(self, tick, events):
+        if events:
+            self.writeEvents(REPLAY_TICK, tick, events)
+    def poll(self, tick, events):
+        self.writeEvents(REPLAY_POLL, tick, events)
+    def close(self, tick):
+        self.file.write(replayRecord.pack(REPLAY_END, tick, 0))
+        self.file.close()
+
+class ReplayReader:
+    def __init__(self, filename):
+        f = open(filename, "rb")
+        data = f.read()
+        f.close()
+        if len(data) < replayHeader.size:
+            raise ReplayError("%s is not a replay" % filename)
+        magic, version = replayHeader.unpack_from(data, 0)
+        if magic != REPLAY_MAGIC:
+            raise ReplayError("%s is not a replay" % filename)
+        if version != REPLAY_VERSION:
+            raise ReplayError("%s is replay version %s, expected %s" % (filename, version, REPLAY_VERSION))
+        self.records = []
+        offset = replayHeader.size
+        while offset + replayRecord.size <= len(data):
+            kind, tick, count = replayRecord.unpack_from(data, offset)
+            offset += replayRecord.size
+            if kind == REPLAY_WORLD:
+                payload = replayWorld.unpack_from(data, offset)
+                offset += replayWorld.size
+            else:
+                payload = []
+                for x in range(count):
+                    payload.append(unpackEvent(data, offset))
+                    offset += replayEvent.size
+            self.records.append((kind, tick, payload))
+        # a log cut short by a crash just ends where the last record did
+        self.cursor = 0
+        self.prompts = False
+    def peek(self):
+        if self.cursor < len(self.records):
+            return self.records[self.cursor]
+        return (REPLAY_END, None, [])
+    def nextWorld(self):
+        # skips to the next world, returns (seed, best score, done tutorial)
+        # or None when there aren't any left
+        while self.cursor < len(self.records):
+            kind, tick, payload = self.records[self.cursor]
+            self.cursor += 1
+            if kind == REPLAY_WORLD:
+                seed, bestScore, doneTutorial, prompts = payload
+                self.prompts = bool(prompts)
+                return seed, bestScore, bool(doneTutorial)
+        return None
+    def worldFinished(self, tick):
+        kind, endTick, payload = self.peek()
+        if kind == REPLAY_WORLD: return tick >= endTick
+        return kind == REPLAY_END and (endTick is None or tick >= endTick)
+    def events(self, tick):
+        kind, recordTick, payload = self.peek()
+        if kind == REPLAY_TICK and recordTick == tick:
+            self.cursor += 1
+            return payload
+        return []
+    def poll(self, tick):
+        kind, recordTick, payload = self.peek()
+        if kind != REPLAY_POLL or recordTick != tick:
+            raise ReplayError("replay is out of step with the simulation at tick %s" % tick)
+        self.cursor += 1
+        return payload
+
+class World:
+    def __init__(self, context, seed = None):
+        # everything random in a world comes from this seed, so a replay only
+        # has to know the seed and the input to play out the same way
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(32)
+        self.seed = seed
+        random.seed(seed)
+        # the last world's particles and toasts went with it
+        getParticleBudget().used = 0
+        context.toastManager.clear()
+        self.context = context
+        width, height = getResolution()
+        self.player = Player(Vec2D(float(width//2),float(height//2)), context.clock)
+        self.player.setClipValues((0,0),(width,height),True)
+        self.spawner = EntitySpawner(Vec2D(0.0,0.0), AsteroidFactory(self.player), [500,5000], 10, context.clock)
+        self.asteroids = self.spawner.factory.field
+        self.upgradeShop = UpgradeShop(self.player)
+        self.events = EventBus()
+        self.entities = EntityRegistry([ self.player, self.spawner, self.asteroids, self.upgradeShop, context.toastManager ], self.events)
+        self.ticks = 0
+        if context.recorder is not None:
+            context.recorder.beginWorld(context.clock.ticks, seed, self.player.bestScoreEver,\
+                                        self.player.gameConfig.getValue("misc", "doneTutorial") == "True", context.canPrompt())
+    def step(self, events = []):
+        # anything spawned this tick is queued and starts thinking next tick
+        if self.context.recorder is not None:
+            self.context.recorder.tick(self.context.clock.ticks, events)
+        profiler = getProfiler()
+        if profiler is not None:
+            notifyStart = timer()
+        for event in events:
+            self.events.dispatch(event)
+        systems = self.entities.systems
+        self.asteroids.rebuildIndex()
+        self.context.asteroids = self.asteroids
+        if profiler is None:
+            for system in systems:
+                for entity in system:
+                    entity.think(self.entities, self.context)
+        else:
+            thinkStart = timer()
+            profiler.add("notify", thinkStart - notifyStart)
+            start = thinkStart
+            for system in systems:
+                for entity in system:
+                    entity.think(self.entities, self.context)
+                    now = timer()
+                    profiler.addEntity("think", entity.__class__.__name__, now - start)
+                    start = now
+            profiler.add("think", start - thinkStart)
+            moveStart = start
+        for system in systems:
+            for entity in system:
+                if entity.removeMe:
+                    self.entities.despawn(entity)
+                else:
+                    entity.move()
+        if profiler is not None:
+            removalStart = timer()
+            profiler.add("move", removalStart - moveStart)
+        self.entities.flush()
+        if profiler is not None:
+            profiler.add("removal", timer() - removalStart)
+        self.ticks += 1
+        self.context.clock.advance()
+    def entityCount(self):
+        # every asteroid counts as one, rather than the field they all live in
+        return len(self.entities) - 1 + self.asteroids.count
+    def render(self, dest, alpha = 1.0):
+        # alpha is how far we are between the last tick and the next one,
+        # returns the screen rects that were drawn over
+        drawn = []
+        overlays = self.entities.system("overlays")
+        beginSpriteBatch(dest)
+        for system in self.entities.systems:
+            if system is overlays: continue
+            for entity in system:
+                self.renderEntity(entity, dest, alpha, drawn)
+        drawn.extend(endSpriteBatch())
+        # GUI goes over the top of everything the batch just drew
+        for entity in overlays:
+            self.renderEntity(entity, dest, alpha, drawn)
+        return drawn
+    def renderEntity(self, entity, dest, alpha, drawn):
+        width, height = getResolution()
+        actualPos = entity.pos
+        entity.pos = entity.interpolated(alpha)
+        if entity.onScreen((0,0), (width,height)):
+            profiler = getProfiler()
+            if profiler is None:
+                entity.render(dest)
+            else:
+                start = timer()
+                entity.render(dest)
+                profiler.addEntity("render", entity.__class__.__name__, timer() - start)
+            rect = entity.screenRect()
+            if rect is not None:
+                drawn.append(rect)
+        entity.pos = actualPos
+
+class FullScreenRenderer:
+    def __init__(self, screen):
+        self.screen = screen
+    def begin(self, context):
+        self.screen.fill((0,0,0))
+    def end(self, drawn):
+        pygame.display.flip()
+
+class DirtyRectRenderer:
+    # only clears and pushes the parts of the screen drawn on last frame or
+    # this one, anything that painted over the whole screen sets redrawAll
+    def __init__(self, screen):
+        self.screen = screen
+        self.bounds = screen.get_rect()
+        self.lastDrawn = []
+        self.fullRedraw = True
+    def begin(self, context):
+        if context.redrawAll:
+            context.redrawAll = False
+            self.fullRedraw = True
+        if self.fullRedraw:
+            self.screen.fill((0,0,0))
+        else:
+            for rect in self.lastDrawn:
+                self.screen.fill((0,0,0), rect)
+    def end(self, drawn):
+        drawn = [rect.clip(self.bounds) for rect in drawn]
+        if self.fullRedraw:
+            pygame.display.flip()
+            self.fullRedraw = False
+        else:
+            pygame.display.update(self.lastDrawn + drawn)
+        self.lastDrawn = drawn
+
+class FrameScheduler:
+    # paces the main loop. while the game's being played it runs at the frame
+    # rate, but when nothing would change on screen (a modal scene waiting for
+    # input, or the window not having focus) it blocks on the event queue so
+    # an idle game doesn't keep a core busy
+    wakeEvent = pygame.USEREVENT + 1
+    def __init__(self, fps = 60, idleTimeout = 1000):
+        self.clock = pygame.time.Clock()
+        self.fps = fps
+        self.idleTimeout = idleTimeout # ms, longest we block without any input
+        self.focused = True
+        self.redraw = False # something outside the game wants the screen drawn
+        self.pumpTime = 0.0 # seconds the last frame spent fetching events, not waiting for them
+    def idle(self, context):
+        if self.redraw: return False
+        if not self.focused: return True
+        return context.scenes.active() and not context.scenes.dirty
+    def notice(self, event):
+        if event.type == pygame.ACTIVEEVENT and event.state & (pygame.APPINPUTFOCUS | pygame.APPACTIVE):
+            self.focused = bool(event.gain)
+            self.redraw = True
+        elif event.type == pygame.VIDEOEXPOSE:
+            self.redraw = True
+    def drawn(self):
+        self.redraw = False
+    def nextFrame(self, context):
+        # returns the events for the next frame, however long that takes
+        if not self.idle(context):
+            self.clock.tick(self.fps)
+            pumpStart = timer()
+            events = pygame.event.get()
+            self.pumpTime = timer() - pumpStart
+            return events
+        # event.wait can't time out on older pygames, a timer event wakes it
+        # instead so the loop still comes round every so often
+        pygame.time.set_timer(self.wakeEvent, self.idleTimeout)
+        events = [pygame.event.wait()]
+        pumpStart = timer()
+        events += pygame.event.get()
+        self.pumpTime = timer() - pumpStart
+        pygame.time.set_timer(self.wakeEvent, 0)
+        # keep the frame time from counting the time spent asleep
+        self.clock.tick()
+        return [event for event in events if event.type != self.wakeEvent]
+    def getFps(self):
+        return self.clock.get_fps()
+
+class CollectionScheduler:
+    # keeps the cyclic collector from stopping the game in the middle of a
+    # frame. automatic collection is off while the game runs and frame() is
+    # called between frames instead. the young generations are cheap and are
+    # collected there as they fill up, full collections wait until the game
+    # is idle unless they've been put off for far too long
+    def __init__(self, patience = 10):
+        # PyPy's collector is incremental and has none of this to schedule
+        self.enabled = hasattr(gc, "get_count")
+        if self.enabled:
+            self.thresholds = gc.get_threshold()
+        self.patience = patience # times the usual gen 2 threshold it'll wait for
+    def start(self):
+        if not self.enabled: return
+        # whatever's loaded when a game starts lives until the next one, so
+        # it's moved out of the collector's way where that's supported
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        gc.disable()
+    def stop(self):
+        if not self.enabled: return
+        gc.enable()
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+    def frame(self, idle):
+        if not self.enabled: return
+        young, middle, old = gc.get_count()
+        if old and (idle or old >= self.thresholds[2] * self.patience):
+            gc.collect()
+        elif middle >= self.thresholds[1]:
+            gc.collect(1)
+        elif young >= self.thresholds[0]:
+            gc.collect(0)
+
+def makeToastManager(clock):
+    width, height = getResolution()
+    return ToastManager(10,(50,50,255),(255,255,0),3000,Vec2D(0,height+2),ToastManager.up,0.5,clock)
+
+def welcomeToast(world, toastManager):
+    thePlayer = world.player
+    if thePlayer.gameConfig.hasValue("misc","doneTutorial") == False\
+       or thePlayer.gameConfig.getValue("misc","doneTutorial") == "False":
+        toastManager.popup("Welcome to Asteroids Survival! :)")
+
+def worldSummary(world):
+    # enough to tell whether two runs of a world played out the same
+    return (world.seed, world.ticks, world.player.score)
+
+def runHeadless(ticks, inputSource = None, recorder = None, maxAsteroids = None, summaries = None):
+    # no window and no display flips, just the simulation as fast as it will go.
+    # nobody's playing, so nothing it does goes into the saved settings
+    getSettings().readonly = True
+    pygame.font.init()
+    context = GameContext()
+    context.toastManager = makeToastManager(context.clock)
+    context.recorder = recorder
+    def newWorld():
+        world = World(context)
+        if maxAsteroids is not None:
+            # stress mode, a new asteroid every tick until there are maxAsteroids
+            world.spawner.maximum = maxAsteroids
+            world.spawner.delay = [0, 0]
+        return world
+    world = newWorld()
+    games = 1
+    for tick in range(ticks):
+        events = []
+        if inputSource is not None:
+            events = inputSource(world)
+        world.step(events)
+        profiler = getProfiler()
+        if profiler is not None:
+            profiler.endFrame()
+        if context.reset:
+            context.reset = False
+            if summaries is not None:
+                summaries.append(worldSummary(world))
+            world = newWorld()
+            games += 1
+    if summaries is not None:
+        summaries.append(worldSummary(world))
+    if recorder is not None:
+        recorder.close(context.clock.ticks)
+    return world, games
+
+def runReplay(filename, headless = False, summaries = None):
+    # plays a recorded session back, in real time in a window or headless
+    # as fast as it will go. settings are read but never saved during a replay
+    reader = ReplayReader(filename)
+    getSettings().readonly = True
+    screen = None
+    if headless:
+        pygame.font.init()
+    else:
+        pygame.init()
+        pygame.font.init()
+        flags = 0
+        if isFullscreen():
+            flags += pygame.FULLSCREEN
+        screen = pygame.display.set_mode(getResolution(), flags)
+        renderer = FullScreenRenderer(screen)
+        if useDirtyRects():
+            renderer = DirtyRectRenderer(screen)
+        limitFps = pygame.time.Clock()
+    context = GameContext(screen)
+    context.replay = reader
+    context.toastManager = makeToastManager(context.clock)
+    world = None
+    games = 0
+    start = reader.nextWorld()
+    while start is not None:
+        seed, bestScore, doneTutorial = start
+        world = World(context, seed)
+        world.player.bestScoreEver = bestScore
+        world.player.gameConfig.makeValue("misc", "doneTutorial", str(doneTutorial))
+        welcomeToast(world, context.toastManager)
+        games += 1
+        while not context.reset and not reader.worldFinished(context.clock.ticks):
+            if context.scenes.active():
+                context.scenes.handle(reader.poll(context.clock.ticks), context)
+            else:
+                world.step(reader.events(context.clock.ticks))
+            if screen is not None:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT\
+                       or event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                        return world, games
+                limitFps.tick(int(round(1.0 / context.clock.dt)))
+                if context.scenes.active():
+                    context.redrawAll = True
+                renderer.begin(context)
+                drawn = []
+                if not context.scenes.covered():
+                    drawn = world.render(screen)
+                if context.scenes.active():
+                    context.scenes.render(screen)
+                renderer.end(drawn)
+            # a replay is one tick and at most one frame per time round
+            profiler = getProfiler()
+            if profiler is not None:
+                profiler.endFrame()
+        if summaries is not None:
+            summaries.append(worldSummary(world))
+        context.reset = False
+        start = reader.nextWorld()
+    return world, games
 
 def runGame():
     pygame.init()
@@ -1076,73 +2736,175 @@ def runGame():
     if isFullscreen():
         flags += pygame.FULLSCREEN
     screen = pygame.display.set_mode((width, height), flags)
-    clock = pygame.time.Clock()
+    scheduler = FrameScheduler()
+    collector = CollectionScheduler()
+    # leave a little of each frame spare for the display and the OS
+    detailController = DetailController(getParticleBudget(), 0.8 / scheduler.fps)
     pygame.font.init()
-    myFont = makeFont(10)
-    context = GameContext()
-    context.screen = screen
-    toastManager = ToastManager(10,(50,50,255),(255,255,0),3000,Vec2D(0,height+2),ToastManager.up,0.5)
+    fpsText = HudText(10, (0,255,0))
+    entityText = HudText(10, (255,255,255))
+    scoreText = HudText(10, (255,255,255))
+    roundText = HudText(10, (255,255,0))
+    bestText = HudText(10, (255,100,100))
+    context = GameContext(screen)
+    profiling = "--profile" in sys.argv
+    profiler = FrameProfiler(keepAll = profiling)
+    profiler.enabled = profiling
+    profilerOverlay = ProfilerOverlay(profiler)
+    setProfiler(profiler)
+    if useDirtyRects():
+        renderer = DirtyRectRenderer(screen)
+    else:
+        renderer = FullScreenRenderer(screen)
+    tickLength = context.clock.dt
+    maxFrameTime = 0.25 # never try to catch up more than this in one go
+    toastManager = makeToastManager(context.clock)
     context.toastManager = toastManager
+    if "--record" in sys.argv:
+        replayName = "session.replay"
+        index = sys.argv.index("--record")
+        if index + 1 < len(sys.argv) and not sys.argv[index + 1].startswith("--"):
+            replayName = sys.argv[index + 1]
+        context.recorder = ReplayWriter(replayName)
+    def quitAnswered(result):
+        if result:
+            context.run = False
     while context.run:
-        reset = False
-        thePlayer = Player(Vec2D(float(width/2),float(height/2)))
-        thePlayer.setClipValues((0,0),(width,height),True)
-        spawner = EntitySpawner(Vec2D(0.0,0.0), AsteroidFactory(thePlayer), [500,5000], 10)
-        upgradeShop = UpgradeShop(thePlayer)
-        entities = [ thePlayer, spawner, upgradeShop, toastManager ]
-        if thePlayer.gameConfig.hasValue("misc","doneTutorial") == False\
-           or thePlayer.gameConfig.getValue("misc","doneTutorial") == "False":
-            toastManager.popup("Welcome to Asteroids Survival! :)")
+        world = World(context)
+        collector.start()
+        context.redrawAll = True
+        thePlayer = world.player
+        welcomeToast(world, toastManager)
+        accumulator = 0.0
+        pendingEvents = []
+        previous = time.time()
         while context.run and not context.reset:
-            clock.tick(60)
-            fps = clock.get_fps()
+            events = scheduler.nextFrame(context)
+            frameStart = timer()
+            fps = scheduler.getFps()
             fpsColour = (0,255,0)
             if fps <= 50: fpsColour = (255,255,0)
             if fps <= 40: fpsColour = (255,0,0)
+            eventsStart = timer()
             eventsToSend = []
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT\
-                   or event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            for event in events:
+                scheduler.notice(event)
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    profiler.enabled = not profiler.enabled
+                    context.redrawAll = True
+                    context.scenes.dirty = True
+                elif event.type == pygame.QUIT\
+                   or event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE and not context.scenes.active():
                     confirmExit = PopupMessageYesNo("Are you sure you want to quit?", (50,50,255), (255,255,0))
-                    result = confirmExit.activate(None, context)
-                    if result:
-                        context.run = False
-                        break
+                    # quitting isn't part of the game, keep it out of the replay
+                    confirmExit.recorded = False
+                    confirmExit.activate(context, quitAnswered)
                 else:
                     eventsToSend.append(event)
-            toRemove = []
-            for entity in entities:
-                for event in eventsToSend:
-                    entity.notify(event)
-                entity.think(entities, context)
-                if entity.removeMe and entity not in toRemove:
-                    toRemove.append(entity)
-                else:
-                    entity.move()
-            for bad in toRemove:
-                entities.remove(bad)
-            screen.fill((0,0,0))
-            for entity in entities:
-                if entity.onScreen((0,0), (width,height)):
-                    entity.render(screen)
-            fpsRender = myFont.render("FPS: %s" % fps, True, fpsColour)
-            pygame.Surface.blit(screen, fpsRender, (0,0,0,0))
-            entityCounter = myFont.render("Entities: %s" % len(entities), True, (255,255,255))
-            pygame.Surface.blit(screen, entityCounter, (0,height - 10,0,0))
-            scoreBoard = myFont.render("Score Remaining to Spend: %s" % thePlayer.score, True, (255,255,255))
-            pygame.Surface.blit(screen, scoreBoard, ((width - scoreBoard.get_size()[0]) / 2, 5, 0,0))
-            highestScore = myFont.render("Total Score This Round: %s" % thePlayer.highestScore, True, (255,255,0))
-            pygame.Surface.blit(screen, highestScore, ((width - highestScore.get_size()[0]) / 2, 15, 0,0))
-            bestScore = myFont.render("Best Score Ever: %s" % thePlayer.bestScoreEver, True, (255,100,100))
-            pygame.Surface.blit(screen, bestScore, ((width - bestScore.get_size()[0]) / 2, 25, 0,0))
-            pygame.display.flip()
-        entities = []
+            if context.scenes.active():
+                # the world waits while anything's open over it
+                context.scenes.handle(eventsToSend, context)
+            else:
+                pendingEvents.extend(eventsToSend)
+            if profiler.enabled:
+                profiler.add("events", scheduler.pumpTime + timer() - eventsStart)
+            now = time.time()
+            if context.scenes.active() or not scheduler.focused:
+                # the world waits while anything's open over it or the window's
+                # in the background, only draw when something might have changed
+                accumulator = 0.0
+                previous = now
+                if not context.scenes.dirty and not scheduler.redraw:
+                    if profiler.enabled:
+                        profiler.endFrame(True)
+                    collector.frame(True)
+                    continue
+            accumulator += min(now - previous, maxFrameTime)
+            previous = now
+            while accumulator >= tickLength and not context.reset and not context.scenes.active():
+                world.step(pendingEvents)
+                pendingEvents = []
+                accumulator -= tickLength
+            renderStart = timer()
+            if context.scenes.active() or scheduler.redraw:
+                context.redrawAll = True
+            scheduler.drawn()
+            renderer.begin(context)
+            drawn = []
+            hudStart = timer()
+            if not context.scenes.covered():
+                drawn = world.render(screen, accumulator / tickLength)
+                hudStart = timer()
+                fpsRender = fpsText.update("FPS: %d" % round(fps), fpsColour)
+                drawn.append(pygame.Surface.blit(screen, fpsRender, (0,0,0,0)))
+                entityCounter = entityText.update("Entities: %s" % world.entityCount())
+                drawn.append(pygame.Surface.blit(screen, entityCounter, (0,height - 10,0,0)))
+                scoreBoard = scoreText.update("Score Remaining to Spend: %s" % thePlayer.score)
+                drawn.append(pygame.Surface.blit(screen, scoreBoard, ((width - scoreBoard.get_size()[0]) // 2, 5, 0,0)))
+                highestScore = roundText.update("Total Score This Round: %s" % thePlayer.highestScore)
+                drawn.append(pygame.Surface.blit(screen, highestScore, ((width - highestScore.get_size()[0]) // 2, 15, 0,0)))
+                bestScore = bestText.update("Best Score Ever: %s" % thePlayer.bestScoreEver)
+                drawn.append(pygame.Surface.blit(screen, bestScore, ((width - bestScore.get_size()[0]) // 2, 25, 0,0)))
+            if context.scenes.active():
+                context.scenes.render(screen)
+            if profiler.enabled:
+                drawn.extend(profilerOverlay.render(screen))
+            flipStart = timer()
+            renderer.end(drawn)
+            if profiler.enabled:
+                profiler.add("render", hudStart - renderStart)
+                profiler.add("hud", flipStart - hudStart)
+                profiler.add("flip", timer() - flipStart)
+                profiler.endFrame()
+            idle = context.scenes.active() or not scheduler.focused
+            if not idle:
+                detailController.frame(timer() - frameStart)
+            collector.frame(idle)
         context.reset = False
+    collector.stop()
+    if context.recorder is not None:
+        context.recorder.close(context.clock.ticks)
+    # --profile keeps every frame, otherwise whatever F3 turned on still
+    # gets dumped, as far back as the overlay's history goes
+    if profiling or profiler.history:
+        profiler.dump("profile")
 
 if __name__ == "__main__":
     try:
         loadGraphicsSettings()
-        runGame()
+        if "--replay" in sys.argv:
+            replayName = sys.argv[sys.argv.index("--replay") + 1]
+            profiling = "--profile" in sys.argv
+            if profiling:
+                setProfiler(FrameProfiler(keepAll = True))
+            start = time.time()
+            world, games = runReplay(replayName, "--headless" in sys.argv)
+            taken = time.time() - start
+            if world is not None:
+                print("%s ticks (%s games) in %.2fs, final score %s" % (world.context.clock.ticks, games, taken, world.player.score))
+            if profiling:
+                getProfiler().dump("profile")
+        elif "--headless" in sys.argv:
+            ticks = 10000
+            index = sys.argv.index("--headless")
+            if index + 1 < len(sys.argv) and sys.argv[index + 1].isdigit():
+                ticks = int(sys.argv[index + 1])
+            maxAsteroids = None
+            if "--asteroids" in sys.argv:
+                maxAsteroids = int(sys.argv[sys.argv.index("--asteroids") + 1])
+            profiling = "--profile" in sys.argv
+            if profiling:
+                setProfiler(FrameProfiler(keepAll = True))
+            start = time.time()
+            world, games = runHeadless(ticks, maxAsteroids = maxAsteroids)
+            taken = time.time() - start
+            print("%s ticks (%s games) in %.2fs, %.1f ticks/s" % (ticks, games, taken, ticks / max(taken, 0.000001)))
+            if profiling:
+                getProfiler().dump("profile")
+        else:
+            runGame()
     except:
         sys.excepthook(*sys.exc_info())
-        raw_input("press enter...")
+        if "--headless" not in sys.argv:
+            input("press enter...")
+    flushSettings()
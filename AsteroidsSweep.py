@@ -0,0 +1,231 @@
+from __future__ import division, print_function
+import AsteroidsSurvival as game
+import pygame
+import numpy
+import multiprocessing
+import itertools
+import collections
+import random
+import math
+import json
+import time
+import sys
+
+# plays seeded headless games with a bot over every combination of the
+# balance settings in the grid, spread over a process pool. each game is
+# written to sweep_results.jsonl as one line of JSON as soon as it finishes
+
+GRID = collections.OrderedDict([
+    ("asteroidSize", [24, 32, 40]),
+    ("spawnDelay", [[250,2500], [500,5000]]),
+    ("spawnMaximum", [10, 20]),
+    ("priceScale", [0.5, 1.0, 2.0]),
+])
+
+# modifier effects the grid can set, anything left out keeps its default
+EFFECTS = {
+    "engineEfficiency": (game.ImprovedEngineModifier, "efficiency"),
+    "rapidFireCut": (game.RapidFireModifier, "delayCut"),
+    "bulletGrowth": (game.LargerBulletModifier, "growth"),
+    "evasionDistance": (game.AutoEvasionModifier, "panicDistance"),
+    "evasionForce": (game.AutoEvasionModifier, "force"),
+}
+EFFECT_DEFAULTS = dict([(name, getattr(cls, attribute)) for name, (cls, attribute) in EFFECTS.items()])
+
+class KeyState:
+    # turns the set of keys a bot wants held into KEYDOWN and KEYUP events
+    def __init__(self):
+        self.held = set()
+    def press(self, wanted):
+        events = []
+        for key in self.held - wanted:
+            events.append(pygame.event.Event(pygame.KEYUP, {"key": key, "mod": 0}))
+        for key in wanted - self.held:
+            events.append(pygame.event.Event(pygame.KEYDOWN, {"key": key, "mod": 0}))
+        self.held = set(wanted)
+        return events
+    def fire(self, player):
+        # the gun only goes off once per press unless it's automatic
+        if pygame.K_SPACE in self.held and not player.fire:
+            return [pygame.event.Event(pygame.KEYDOWN, {"key": pygame.K_SPACE, "mod": 0})]
+        return []
+
+def buy(world, index):
+    shop = world.upgradeShop
+    shop.autoConfirm = True
+    shop.buyItemButton((shop, index, world.context))
+
+def affordable(world):
+    # (price, index) of everything in the shop the player could buy right now
+    found = []
+    for index, (price, name, mod, button, level, maxLevel) in enumerate(world.upgradeShop.buyable):
+        if button.enabled and world.player.score >= price + 100:
+            found.append((price, index))
+    return found
+
+class RandomBot:
+    # mashes a new random set of keys every so often and now and then buys
+    # whatever it can afford
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.keys = KeyState()
+        self.wanted = set()
+        self.nextChange = 0
+    def __call__(self, world):
+        if world.ticks >= self.nextChange:
+            self.nextChange = world.ticks + game.randint(10, 60, self.random)
+            self.wanted = set([key for key in [pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d, pygame.K_SPACE]\
+                               if self.random.random() < 0.3])
+            choices = affordable(world)
+            if choices and self.random.random() < 0.2:
+                buy(world, choices[game.randrange(len(choices), self.random)][1])
+        return self.keys.press(self.wanted) + self.keys.fire(world.player)
+
+class ScriptedBot:
+    # turns towards the nearest asteroid and shoots at it, backs away from
+    # anything too close and spends spare score on the cheapest upgrade
+    def __init__(self, seed, reserve = 200):
+        self.keys = KeyState()
+        self.reserve = reserve
+    def __call__(self, world):
+        player = world.player
+        px, py = player.pos.get()
+        asteroids = world.asteroids
+        count = asteroids.count
+        wanted = set()
+        if count:
+            positions = asteroids.positions[:count]
+            distances = numpy.hypot(positions[:, 0] - px, positions[:, 1] - py) - asteroids.sizes[:count]
+            nearest = int(numpy.argmin(distances))
+            nearestDistance = distances[nearest]
+            nx, ny = positions[nearest].tolist()
+            angle = math.atan2(ny - py, nx - px)
+            turn = (angle - player.bearing + math.pi) % (2 * math.pi) - math.pi
+            if turn > 0.1:
+                wanted.add(pygame.K_d)
+            elif turn < -0.1:
+                wanted.add(pygame.K_a)
+            if abs(turn) < 0.3:
+                wanted.add(pygame.K_SPACE)
+            if nearestDistance < 120:
+                wanted.add(pygame.K_s)
+        choices = affordable(world)
+        if choices:
+            price, index = min(choices)
+            if player.score >= price + 100 + self.reserve:
+                buy(world, index)
+        return self.keys.press(wanted) + self.keys.fire(player)
+
+POLICIES = {
+    "random": RandomBot,
+    "scripted": ScriptedBot,
+}
+
+def configure(world, params):
+    # anything the grid leaves out is played at the game's own value
+    if "asteroidSize" in params:
+        world.spawner.factory.asteroidSize = params["asteroidSize"]
+        world.asteroids.setMargin(params["asteroidSize"])
+    if "spawnDelay" in params:
+        world.spawner.delay = list(params["spawnDelay"])
+    if "spawnMaximum" in params:
+        world.spawner.maximum = params["spawnMaximum"]
+    if "priceScale" in params:
+        shop = world.upgradeShop
+        for index, (price, name, mod, button, level, maxLevel) in enumerate(shop.buyable):
+            shop.buyable[index] = (price * params["priceScale"], name, mod, button, level, maxLevel)
+
+def initWorker():
+    pygame.font.init()
+    # bots would otherwise end up in the real high scores
+    game.getSettings().readonly = True
+
+def playGame(job):
+    # one seeded game to the end or maxTicks, whichever comes first
+    params, policy, seed, maxTicks = job
+    for name, value in EFFECT_DEFAULTS.items():
+        cls, attribute = EFFECTS[name]
+        setattr(cls, attribute, params.get(name, value))
+    context = game.GameContext()
+    context.toastManager = game.makeToastManager(context.clock)
+    world = game.World(context, seed)
+    configure(world, params)
+    bot = POLICIES[policy](seed)
+    entitiesPeak = 0
+    start = time.time()
+    while world.ticks < maxTicks and not context.reset:
+        world.step(bot(world))
+        entitiesPeak = max(entitiesPeak, world.entityCount())
+    taken = time.time() - start
+    player = world.player
+    bought = []
+    for price, name, mod, button, level, maxLevel in world.upgradeShop.buyable:
+        if not level: continue
+        # the label names the next level up once there is one, the level
+        # number is dropped and the modifier it's on now is recorded instead
+        if maxLevel > 1:
+            name = name.rsplit(" ", 1)[0]
+        bought.append([name, mod.__class__.__name__, level])
+    return {"params": params, "policy": policy, "seed": seed, "survived": not player.lostGame,\
+            "survivalTicks": world.ticks, "survivalSeconds": world.ticks * context.clock.dt,\
+            "score": player.score, "roundScore": player.highestScore, "upgrades": bought,\
+            "entitiesPeak": entitiesPeak,\
+            "seconds": taken, "ticksPerSecond": world.ticks / max(taken, 0.000001)}
+
+def makeJobs(grid, policies, seeds, firstSeed, maxTicks):
+    names = list(grid.keys())
+    jobs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        params = dict(zip(names, values))
+        for policy in policies:
+            for seed in range(firstSeed, firstSeed + seeds):
+                jobs.append((params, policy, seed, maxTicks))
+    return jobs
+
+def argument(name, default):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+def main():
+    maxTicks = int(argument("--ticks", 60 * 60 * 5))
+    seeds = int(argument("--seeds", 4))
+    firstSeed = int(argument("--seed", 1))
+    processes = int(argument("--processes", multiprocessing.cpu_count()))
+    policies = argument("--policy", "random,scripted").split(",")
+    resultsName = argument("--output", "sweep_results.jsonl")
+    gridName = argument("--grid", None)
+    grid = GRID
+    if gridName is not None:
+        # a JSON object of parameter name to the list of values to try
+        f = open(gridName, "r")
+        grid = collections.OrderedDict(sorted(json.load(f).items()))
+        f.close()
+    for policy in policies:
+        if policy not in POLICIES:
+            print("unknown policy %s, choose from %s" % (policy, ", ".join(sorted(POLICIES.keys()))))
+            return 1
+    for name in grid.keys():
+        if name not in GRID and name not in EFFECTS:
+            print("unknown parameter %s" % name)
+            return 1
+    jobs = makeJobs(grid, policies, seeds, firstSeed, maxTicks)
+    print("%s games over %s processes" % (len(jobs), processes))
+    pool = multiprocessing.Pool(processes, initWorker)
+    f = open(resultsName, "w")
+    start = time.time()
+    done = 0
+    for result in pool.imap_unordered(playGame, jobs):
+        f.write(json.dumps(result, sort_keys = True) + "\n")
+        f.flush()
+        done += 1
+        if done % 10 == 0 or done == len(jobs):
+            print("%s/%s games, %.1fs" % (done, len(jobs), time.time() - start))
+    f.close()
+    pool.close()
+    pool.join()
+    print("results in %s" % resultsName)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())